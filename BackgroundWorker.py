@@ -0,0 +1,107 @@
+import queue
+import threading
+
+
+class BackgroundJob:
+    def __init__(self, messages):
+        """
+        Handle given to work running on a worker thread.
+        :param messages: Queue the job posts progress and results to.
+        """
+        self.__messages = messages
+        self.__cancelled = threading.Event()
+
+    def cancel(self):
+        self.__cancelled.set()
+
+    def is_cancelled(self):
+        """Work should check this between stages and return early once it is set."""
+        return self.__cancelled.is_set()
+
+    def report(self, fraction, message=""):
+        """Post progress back to the Tk thread. Safe to call from the worker thread."""
+        self.__messages.put((self, "progress", (fraction, message)))
+
+
+class BackgroundWorker:
+    def __init__(self, widget, poll_ms=30):
+        """
+        Runs one job at a time on a worker thread and delivers its progress and result
+        on the Tk main loop. Submitting a new job cancels the one in flight.
+        :param widget: Any Tk widget, used to poll for messages with after().
+        :param poll_ms: How often the Tk loop checks for messages while a job runs.
+        """
+        self.__widget = widget
+        self.__poll_ms = poll_ms
+        self.__messages = queue.Queue()
+        self.__job = None
+        self.__callbacks = (None, None, None)
+        self.__on_cancel = None
+        self.__poll_job = None
+
+    def submit(self, work, on_done, on_progress=None, on_error=None, on_cancel=None):
+        """
+        Start work(job) on a worker thread, cancelling any job still in flight.
+        :param work: Called on the worker thread with a BackgroundJob, returns the result.
+        :param on_done: Called on the Tk thread with the result, unless the job was superseded.
+        :param on_progress: Called on the Tk thread with (fraction, message) for each report.
+        :param on_error: Called on the Tk thread with the exception if work raised.
+        :param on_cancel: Called on the Tk thread, without arguments, if the job is cancelled
+            or superseded, e.g. to reset its progress display.
+        """
+        self.cancel()
+        job = BackgroundJob(self.__messages)
+        self.__job = job
+        self.__callbacks = (on_done, on_progress, on_error)
+        self.__on_cancel = on_cancel
+        threading.Thread(target=self.__run, args=(job, work), daemon=True).start()
+        if self.__poll_job is None:
+            self.__poll_job = self.__widget.after(self.__poll_ms, self.__poll)
+        return job
+
+    def cancel(self):
+        """Cancel the job in flight. Its result, if any, is discarded and its on_cancel is called."""
+        if self.__job is not None:
+            self.__job.cancel()
+            self.__job = None
+            on_cancel, self.__on_cancel = self.__on_cancel, None
+            if on_cancel is not None:
+                on_cancel()
+
+    def is_busy(self):
+        return self.__job is not None
+
+    def __run(self, job, work):
+        try:
+            result = work(job)
+        except Exception as error:
+            self.__messages.put((job, "error", error))
+            return
+        self.__messages.put((job, "done", result))
+
+    def __poll(self):
+        self.__poll_job = None
+        while True:
+            try:
+                job, kind, payload = self.__messages.get_nowait()
+            except queue.Empty:
+                break
+            # Messages from superseded or cancelled jobs are dropped.
+            if job is not self.__job or job.is_cancelled():
+                continue
+            on_done, on_progress, on_error = self.__callbacks
+            if kind == "progress":
+                if on_progress is not None:
+                    on_progress(*payload)
+            elif kind == "done":
+                self.__job = None
+                on_done(payload)
+            else:
+                self.__job = None
+                if on_error is not None:
+                    on_error(payload)
+                else:
+                    print("Background job failed:", payload)
+
+        if self.__job is not None:
+            self.__poll_job = self.__widget.after(self.__poll_ms, self.__poll)
@@ -1,5 +1,7 @@
 import cv2
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
 from typing import TYPE_CHECKING
 from Blob import Blob
@@ -17,6 +19,8 @@ class BlobDetector:
         self.__blob_manager = None
         self.__filter_processor = None
         self.__params = cv2.SimpleBlobDetector_Params()
+        self.__tile_size = 1024 # Core size of the tiles detected in parallel
+        self.__pool = None # Thread pool for tiled detection, created on first use
         
     def bind_blob_manager(self, blob_manager):
         self.__blob_manager = blob_manager
@@ -34,28 +38,161 @@ class BlobDetector:
             print("Bind blob manager before blob detection")
             return
 
-        
-        #Delete previously detected blobs
-        self.__blob_manager.reset()
         #get the filtered image
         gray_image = self.__filter_processor.get_current_image()
             
         if gray_image is not None:
-            # Blob detector parameters
-            #min_area = 10#int(self.main_gui.min_area.get() if hasattr(self.main_gui.min_area, 'get') else self.main_gui.min_area)
-            #max_area = 10000#int(self.main_gui.max_area.get() if hasattr(self.main_gui.max_area, 'get') else self.main_gui.max_area)
-
-            detector = cv2.SimpleBlobDetector_create(self.__params)
-
-            # Detect blobs
-            keypoints = detector.detect(gray_image)
+            self.store_blobs(*self.find_blobs(self.snapshot_params(), gray_image))
+
+    def set_max_workers(self, count):
+        """Set how many threads tiled detection uses. Defaults to one per core."""
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False)
+        self.__pool = ThreadPoolExecutor(max_workers=max(int(count), 1))
+
+    def snapshot_params(self):
+        """Copy the current parameters, so detection on a worker thread is unaffected by later UI changes."""
+        params = cv2.SimpleBlobDetector_Params()
+        for name in dir(self.__params):
+            if not name.startswith("_"):
+                setattr(params, name, getattr(self.__params, name))
+        return params
+
+    def find_blobs(self, params, gray_image, cancelled=None):
+        """
+        Detect blobs in a grayscale image. Touches no state, so it can run on a worker thread.
+        Images larger than one tile are detected tile by tile on a thread pool.
+        :param params: Parameters from snapshot_params.
+        :param cancelled: Optional callable, e.g. BackgroundJob.is_cancelled. Once it returns
+            True the tiles not started yet are dropped and None is returned.
+        :return: (xs, ys, rs) arrays of blob centres and radii.
+        """
+        height, width = gray_image.shape[:2]
+        if height <= self.__tile_size and width <= self.__tile_size:
+            return self.__detect(params, gray_image)
+        return self.__find_blobs_tiled(params, gray_image, cancelled)
+
+    def __detect(self, params, gray_image):
+        # Detectors keep scratch state, so each call builds its own
+        keypoints = cv2.SimpleBlobDetector_create(params).detect(gray_image)
+
+        # Extract centres and radii (half the size)
+        points = np.array([keypoint.pt for keypoint in keypoints], dtype=np.float64).reshape(-1, 2)
+        radii = np.array([keypoint.size / 2 for keypoint in keypoints], dtype=np.float64)
+        return points[:, 0], points[:, 1], radii
+
+    def __blob_margin(self, params):
+        # Largest blob radius the area filter allows, so a blob near a border is seen whole
+        if params.filterByArea:
+            return min(int(np.ceil(np.sqrt(params.maxArea / np.pi))) + 1, 256)
+        return 64
+
+    def __find_blobs_tiled(self, params, gray_image, cancelled=None):
+        """
+        Detect overlapping tiles in parallel. Each tile is read with a margin of the largest
+        blob radius and keeps only the blobs centred in its core, so every blob is found by
+        exactly one tile; blobs split across a seam are then merged using minDistBetweenBlobs.
+        """
+        if self.__pool is None:
+            self.__pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+        height, width = gray_image.shape[:2]
+        margin = self.__blob_margin(params)
+        size = self.__tile_size
+
+        def detect_tile(y0, x0):
+            if cancelled is not None and cancelled():
+                return None
+            y1, x1 = min(y0 + size, height), min(x0 + size, width)
+            hy0, hx0 = max(y0 - margin, 0), max(x0 - margin, 0)
+            hy1, hx1 = min(y1 + margin, height), min(x1 + margin, width)
+            xs, ys, rs = self.__detect(params, gray_image[hy0:hy1, hx0:hx1])
+            xs, ys = xs + hx0, ys + hy0
+            core = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+            return xs[core], ys[core], rs[core]
+
+        tiles = [(y0, x0) for y0 in range(0, height, size) for x0 in range(0, width, size)]
+        futures = [self.__pool.submit(detect_tile, y0, x0) for y0, x0 in tiles]
+        for future in as_completed(futures):
+            future.result()
+            if cancelled is not None and cancelled():
+                # Free the shared pool for the job that superseded this one
+                for pending in futures:
+                    pending.cancel()
+                return None
+        results = [future.result() for future in futures]
+        xs = np.concatenate([result[0] for result in results])
+        ys = np.concatenate([result[1] for result in results])
+        rs = np.concatenate([result[2] for result in results])
+        tile_ids = np.concatenate([np.full(len(result[0]), index) for index, result in enumerate(results)])
+
+        keep = self.__merge_seams(xs, ys, rs, tile_ids, params.minDistBetweenBlobs)
+        return xs[keep], ys[keep], rs[keep]
+
+    def __merge_seams(self, xs, ys, rs, tile_ids, min_dist):
+        """
+        Return a mask dropping blobs from different tiles closer than min_dist, the larger
+        blob of each such pair being kept. Only blobs within min_dist of a seam are compared.
+        """
+        keep = np.ones(len(xs), dtype=bool)
+        if min_dist <= 0 or len(xs) == 0:
+            return keep
+
+        size = self.__tile_size
+        near_x = np.minimum(xs % size, size - xs % size) < min_dist
+        near_y = np.minimum(ys % size, size - ys % size) < min_dist
+        candidates = np.flatnonzero(near_x | near_y)
+
+        cells = {} # (cx, cy) -> indices of kept blobs in that min_dist sized cell
+        for i in candidates[np.argsort(-rs[candidates], kind="stable")]:
+            cx, cy = int(xs[i] // min_dist), int(ys[i] // min_dist)
+            duplicate = False
+            for nx in (cx - 1, cx, cx + 1):
+                for ny in (cy - 1, cy, cy + 1):
+                    for j in cells.get((nx, ny), ()):
+                        if tile_ids[j] != tile_ids[i] and (xs[i] - xs[j]) ** 2 + (ys[i] - ys[j]) ** 2 < min_dist ** 2:
+                            duplicate = True
+            if duplicate:
+                keep[i] = False
+            else:
+                cells.setdefault((cx, cy), []).append(i)
+        return keep
+
+    def get_search_region(self, roi, width, height):
+        """
+        Grow a region of interest by the largest blob radius the area filter allows, so blobs
+        straddling its border are seen whole. Clamped to the image.
+        :param roi: (x0, y0, x1, y1) in original image pixels.
+        """
+        margin = self.__blob_margin(self.__params)
+        x0, y0, x1, y1 = roi
+        return (max(int(x0) - margin, 0), max(int(y0) - margin, 0),
+                min(int(np.ceil(x1)) + margin, width), min(int(np.ceil(y1)) + margin, height))
 
-            for keypoint in keypoints:
-                x, y = keypoint.pt  # Extract x, y from the keypoint
-                r = keypoint.size / 2  # Extract radius (half the size)
-    
-                # Create a Blob and add it to the BlobManager
-                self.__blob_manager.add_blob(x, y, r)
+    def find_blobs_in_region(self, params, gray_region, region, roi, cancelled=None):
+        """
+        Detect blobs in the grayscale crop of region and keep the blobs centred inside roi.
+        :return: (xs, ys, rs) arrays in original image coordinates, or None if cancelled.
+        """
+        blobs = self.find_blobs(params, gray_region, cancelled)
+        if blobs is None:
+            return None
+        xs, ys, rs = blobs
+        xs = xs + region[0]
+        ys = ys + region[1]
+        inside = (xs >= roi[0]) & (xs < roi[2]) & (ys >= roi[1]) & (ys < roi[3])
+        return xs[inside], ys[inside], rs[inside]
+
+    def store_blobs(self, xs, ys, rs, roi=None):
+        """
+        Replace the previously detected blobs in the BlobManager.
+        :param roi: If given, only blobs centred inside this (x0, y0, x1, y1) are replaced.
+        """
+        if roi is None:
+            self.__blob_manager.reset()
+            self.__blob_manager.add_blobs(xs, ys, rs)
+        else:
+            self.__blob_manager.replace_blobs_in_rect(*roi, xs, ys, rs)
 
 
     def set_color_params(self, filter_by_color, color):
@@ -69,13 +206,12 @@ class BlobDetector:
         self.__params.maxArea = maxArea
 
     def set_inertia_params(self, filter_by_inertia, minInertia, maxInertia):
-        self.__params.filterByArea = filter_by_inertia
+        self.__params.filterByInertia = filter_by_inertia
         self.__params.minInertiaRatio = minInertia
         self.__params.maxInertiaRatio = maxInertia
 
 
     def set_circularity_params(self, filter_by_circularity, minCircularity, maxCircularity):
-        print("circularity ", minCircularity, " , " ,maxCircularity)
         self.__params.filterByCircularity = filter_by_circularity
         self.__params.minCircularity = minCircularity
         self.__params.maxCircularity = maxCircularity
@@ -0,0 +1,99 @@
+import math
+import numpy as np
+
+
+class BlobGrid:
+    def __init__(self, cell_size=64):
+        """
+        Uniform grid spatial index over blob centres.
+        :param cell_size: Side length of a grid cell in original image pixels.
+        """
+        self.__cell_size = float(cell_size)
+        self.__cells = {}  # (cell_x, cell_y) -> set of items
+
+    def __cell(self, x, y):
+        return (math.floor(x / self.__cell_size), math.floor(y / self.__cell_size))
+
+    def insert(self, item, x, y):
+        """Add an item whose centre is at (x, y)."""
+        self.__cells.setdefault(self.__cell(x, y), set()).add(item)
+
+    def remove(self, item, x, y):
+        """Remove an item that was inserted at (x, y)."""
+        key = self.__cell(x, y)
+        cell = self.__cells.get(key)
+        if cell is None:
+            return
+        cell.discard(item)
+        if not cell:
+            del self.__cells[key]
+
+    def move(self, item, old_x, old_y, new_x, new_y):
+        """Move an item from (old_x, old_y) to (new_x, new_y)."""
+        old_key = self.__cell(old_x, old_y)
+        new_key = self.__cell(new_x, new_y)
+        if old_key == new_key:
+            return
+        self.remove(item, old_x, old_y)
+        self.__cells.setdefault(new_key, set()).add(item)
+
+    def __cells_of(self, xs, ys):
+        return (np.floor(np.asarray(xs) / self.__cell_size).astype(np.int64),
+                np.floor(np.asarray(ys) / self.__cell_size).astype(np.int64))
+
+    def insert_many(self, items, xs, ys):
+        """Vectorized insert of items centred at (xs, ys)."""
+        cxs, cys = self.__cells_of(xs, ys)
+        for item, cx, cy in zip(items, cxs.tolist(), cys.tolist()):
+            self.__cells.setdefault((cx, cy), set()).add(item)
+
+    def remove_many(self, items, xs, ys):
+        """Vectorized remove of items that were inserted at (xs, ys)."""
+        cxs, cys = self.__cells_of(xs, ys)
+        for item, cx, cy in zip(items, cxs.tolist(), cys.tolist()):
+            cell = self.__cells.get((cx, cy))
+            if cell is None:
+                continue
+            cell.discard(item)
+            if not cell:
+                del self.__cells[(cx, cy)]
+
+    def move_many(self, items, old_xs, old_ys, new_xs, new_ys):
+        """Vectorized move. Only items that actually change cell are touched."""
+        items = np.asarray(items)
+        old_cx, old_cy = self.__cells_of(old_xs, old_ys)
+        new_cx, new_cy = self.__cells_of(new_xs, new_ys)
+        changed = (old_cx != new_cx) | (old_cy != new_cy)
+        if not changed.any():
+            return
+        self.remove_many(items[changed].tolist(), np.asarray(old_xs)[changed], np.asarray(old_ys)[changed])
+        self.insert_many(items[changed].tolist(), np.asarray(new_xs)[changed], np.asarray(new_ys)[changed])
+
+    def clear(self):
+        self.__cells.clear()
+
+    def __len__(self):
+        """Number of occupied cells."""
+        return len(self.__cells)
+
+    def cell_span(self, x0, y0, x1, y1):
+        """Number of cells, occupied or not, the rectangle (x0, y0)-(x1, y1) overlaps."""
+        cx0, cy0 = self.__cell(x0, y0)
+        cx1, cy1 = self.__cell(x1, y1)
+        return max(cx1 - cx0 + 1, 0) * max(cy1 - cy0 + 1, 0)
+
+    def candidates(self, x0, y0, x1, y1):
+        """Yield every item whose centre cell overlaps the rectangle (x0, y0)-(x1, y1)."""
+        cx0, cy0 = self.__cell(x0, y0)
+        cx1, cy1 = self.__cell(x1, y1)
+        # Walk whichever is smaller: the cells under the rectangle or the occupied cells.
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= len(self.__cells):
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    cell = self.__cells.get((cx, cy))
+                    if cell:
+                        yield from cell
+        else:
+            for (cx, cy), cell in self.__cells.items():
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+                    yield from cell
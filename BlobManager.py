@@ -1,50 +1,120 @@
-from Blob import Blob
+import numpy as np
+from BlobGrid import BlobGrid
+from BlobStore import BlobStore, BlobView, BlobListView
 
 class BlobManager:
     def __init__(self):
-        self.blobs = []
-        self.selected_blobs = set()  # Store selected blobs
+        self.__store = BlobStore()  # Columnar ids/x/y/r/selected arrays
         self.total_blobs = 0
         self.thickness = 5
+        self.__grid = BlobGrid()  # Indexes blob ids by centre
+        self.__max_radius = 0.0  # Largest radius seen, bounds the grid search around a point
 
     def add_blob(self, x, y, r):
         """Add a blob to the list."""
-        new_blob = Blob(self.total_blobs, x, y, r)
-        self.blobs.append(new_blob)
-        self.total_blobs += 1
+        self.add_blobs(np.array([x]), np.array([y]), np.array([r]))
+
+    def add_blobs(self, xs, ys, rs):
+        """Add many blobs at once from arrays of centres and radii."""
+        if len(xs) == 0:
+            return
+        ids = np.arange(self.total_blobs, self.total_blobs + len(xs))
+        self.__store.append(ids, xs, ys, rs)
+        self.__grid.insert_many(ids.tolist(), xs, ys)
+        self.__max_radius = max(self.__max_radius, float(np.max(rs)))
+        self.total_blobs += len(xs)
+
+    def move_selected_blobs(self, dx, dy):
+        """Translate all selected blobs by (dx, dy), keeping the spatial index in sync."""
+        store = self.__store
+        slots = store.selected_slots()
+        old_x = store.x[slots]
+        old_y = store.y[slots]
+        store.x[slots] += dx
+        store.y[slots] += dy
+        self.__grid.move_many(store.ids[slots], old_x, old_y, store.x[slots], store.y[slots])
+
+    def __grid_slots(self, x0, y0, x1, y1):
+        ids = np.fromiter(self.__grid.candidates(x0, y0, x1, y1), dtype=np.int64)
+        ids.sort()
+        return self.__store.slots_of(ids)
+
+    def __views(self, slots):
+        store = self.__store
+        return [BlobView(store, id, slot) for slot, id in zip(slots.tolist(), store.ids[slots].tolist())]
+
+    def query_point(self, x, y, tolerance=0.0):
+        """Return blobs whose bounding box, grown by tolerance, contains (x, y). Ordered by id."""
+        store = self.__store
+        reach = self.__max_radius + tolerance
+        slots = self.__grid_slots(x - reach, y - reach, x + reach, y + reach)
+        reach = store.r[slots] + tolerance
+        hit = (np.abs(x - store.x[slots]) <= reach) & (np.abs(y - store.y[slots]) <= reach)
+        return self.__views(slots[hit])
+
+    def query_rect(self, x0, y0, x1, y1):
+        """Return blobs lying entirely inside the rectangle (x0, y0)-(x1, y1). Ordered by id."""
+        store = self.__store
+        slots = self.__grid_slots(x0, y0, x1, y1)
+        xs, ys, rs = store.x[slots], store.y[slots], store.r[slots]
+        hit = (xs - rs >= x0) & (xs + rs <= x1) & (ys - rs >= y0) & (ys + rs <= y1)
+        return self.__views(slots[hit])
 
     def get_blobs(self):
-        """Return the list of all blobs."""
-        return self.blobs
+        """Return a view of all blobs."""
+        return BlobListView(self.__store)
 
     def get_selected_blobs(self):
-        """Return the set of selected blobs."""
-        return self.selected_blobs
+        """Return a view of the selected blobs."""
+        return BlobListView(self.__store, selected_only=True)
+
+    def get_columns(self):
+        """Return (ids, x, y, r, selected) arrays of the alive blobs in id order."""
+        store = self.__store
+        slots = store.live_slots()
+        return store.ids[slots], store.x[slots], store.y[slots], store.r[slots], store.selected[slots]
+
+    def get_columns_in_rect(self, x0, y0, x1, y1):
+        """Return (ids, x, y, r, selected) arrays of the alive blobs whose circle overlaps the rectangle. Ordered by id."""
+        store = self.__store
+        reach = self.__max_radius
+        if self.__grid.cell_span(x0 - reach, y0 - reach, x1 + reach, y1 + reach) >= len(self.__grid):
+            # The grid would visit every occupied cell, so test all blobs in one vectorized pass instead
+            slots = store.live_slots()
+        else:
+            slots = self.__grid_slots(x0 - reach, y0 - reach, x1 + reach, y1 + reach)
+        xs, ys, rs = store.x[slots], store.y[slots], store.r[slots]
+        slots = slots[(xs + rs >= x0) & (xs - rs <= x1) & (ys + rs >= y0) & (ys - rs <= y1)]
+        return store.ids[slots], store.x[slots], store.y[slots], store.r[slots], store.selected[slots]
 
     def select_blob(self, blob):
         """Add a blob to the selection set."""
-        if blob in self.blobs:
-            self.selected_blobs.add(blob)
+        if blob.is_alive():
+            self.__store.selected[blob.slot()] = True
+
+    def select_blobs(self, blobs):
+        """Add blobs returned by query_point/query_rect to the selection set."""
+        slots = np.fromiter((blob.slot() for blob in blobs), dtype=np.int64)
+        self.__store.selected[slots] = True
 
     def deselect_blob(self, blob):
         """Remove a blob from the selection set."""
-        self.selected_blobs.discard(blob)
+        if blob.is_alive():
+            self.__store.selected[blob.slot()] = False
 
     def toggle_selection(self, blob):
         """Toggle selection of a blob."""
-        if blob in self.selected_blobs:
-            self.selected_blobs.discard(blob)  # Deselect if already selected
+        if self.is_selected(blob):
+            self.deselect_blob(blob)  # Deselect if already selected
         else:
             self.select_blob(blob) # Select if not already selected
 
     def is_selected(self, blob):
-        if blob in self.selected_blobs:
-            return True
-        return False
-                
+        return blob.is_alive() and bool(self.__store.selected[blob.slot()])
+
     def clear_selection(self):
         """Clear all selected blobs."""
-        self.selected_blobs.clear()
+        self.__store.selected[:self.__store.size] = False
 
     def set_thickness(self, thickness):
         self.thickness = thickness
@@ -54,14 +124,25 @@ class BlobManager:
 
     def reset(self):
         """Reset the BlobManager."""
-        self.blobs.clear()
-        self.selected_blobs.clear()
+        self.__store.clear()
+        self.__grid.clear()
+        self.__max_radius = 0.0
         self.total_blobs = 0
 
+    def replace_blobs_in_rect(self, x0, y0, x1, y1, xs, ys, rs):
+        """Delete the blobs centred inside the rectangle and add the given ones in their place."""
+        store = self.__store
+        slots = self.__grid_slots(x0, y0, x1, y1)
+        inside = (store.x[slots] >= x0) & (store.x[slots] < x1) & (store.y[slots] >= y0) & (store.y[slots] < y1)
+        slots = slots[inside]
+        self.__grid.remove_many(store.ids[slots].tolist(), store.x[slots], store.y[slots])
+        store.kill(slots)
+        self.add_blobs(xs, ys, rs)
+
     def delete_selected_blobs(self):
-        """Delete all selected blobs from the original list without iterator invalidation."""
-        for blob in list(self.selected_blobs):  # Iterate over a copy to avoid modification issues
-            if blob in self.blobs:
-                self.blobs.remove(blob)
-        self.selected_blobs.clear()
- 
+        """Tombstone all selected blobs and drop them from the spatial index."""
+        store = self.__store
+        slots = store.selected_slots()
+        self.__grid.remove_many(store.ids[slots].tolist(), store.x[slots], store.y[slots])
+        store.kill(slots)
+
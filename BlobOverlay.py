@@ -0,0 +1,64 @@
+class BlobOverlay:
+    def __init__(self, canvas, tag="BlobLayer"):
+        """
+        Pool of canvas ovals for the blob layer. Items persist across redraws and are
+        only touched when the blob they show changes; items of blobs that leave the
+        view are hidden and reused for newly visible blobs.
+        :param canvas: The canvas the ovals live on.
+        :param tag: Canvas tag given to every oval.
+        """
+        self.__canvas = canvas
+        self.__tag = tag
+        self.__items = {}  # blob id -> canvas item id
+        self.__state = {}  # blob id -> (box, color, width) last written to the item
+        self.__free = []   # Hidden items ready to be reused
+
+    def update(self, ids, boxes, colors, width):
+        """
+        Show exactly the given blobs.
+        :param ids: Blob ids, as a list.
+        :param boxes: Screen space (x0, y0, x1, y1) per blob.
+        :param colors: Outline colour per blob.
+        :param width: Outline width shared by all blobs.
+        """
+        visible = set(ids)
+        for blob_id in [blob_id for blob_id in self.__items if blob_id not in visible]:
+            self.__recycle(blob_id)
+
+        canvas = self.__canvas
+        for blob_id, box, color in zip(ids, boxes, colors):
+            box = tuple(box)
+            item = self.__items.get(blob_id)
+            if item is None:
+                if self.__free:
+                    item = self.__free.pop()
+                    canvas.coords(item, *box)
+                    canvas.itemconfig(item, outline=color, width=width, state="normal")
+                else:
+                    item = canvas.create_oval(*box, outline=color, width=width, tag=self.__tag)
+                self.__items[blob_id] = item
+            else:
+                old_box, old_color, old_width = self.__state[blob_id]
+                if old_box != box:
+                    canvas.coords(item, *box)
+                if old_color != color or old_width != width:
+                    canvas.itemconfig(item, outline=color, width=width)
+            self.__state[blob_id] = (box, color, width)
+
+    def hide(self):
+        """Hide every oval, keeping the items for reuse."""
+        for blob_id in list(self.__items):
+            self.__recycle(blob_id)
+
+    def clear(self):
+        """Delete every item owned by the overlay."""
+        self.__canvas.delete(self.__tag)
+        self.__items.clear()
+        self.__state.clear()
+        self.__free.clear()
+
+    def __recycle(self, blob_id):
+        item = self.__items.pop(blob_id)
+        del self.__state[blob_id]
+        self.__canvas.itemconfig(item, state="hidden")
+        self.__free.append(item)
@@ -0,0 +1,169 @@
+import numpy as np
+
+
+class BlobStore:
+    def __init__(self, capacity=1024):
+        """
+        Columnar storage for blobs. Each blob occupies one slot in the contiguous
+        ids/x/y/r/selected/alive arrays. Slots are kept in id order, deleted blobs are
+        tombstoned (alive=False) and the arrays are compacted once most slots are dead.
+        :param capacity: Initial number of slots to allocate.
+        """
+        self.size = 0   # Number of slots in use, alive or tombstoned
+        self.count = 0  # Number of alive blobs
+        self.epoch = 0  # Bumped whenever slots are renumbered by compaction
+        self.__allocate(capacity)
+
+    def __allocate(self, capacity):
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.x = np.zeros(capacity, dtype=np.float64)
+        self.y = np.zeros(capacity, dtype=np.float64)
+        self.r = np.zeros(capacity, dtype=np.float64)
+        self.selected = np.zeros(capacity, dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+
+    def __columns(self):
+        return ("ids", "x", "y", "r", "selected", "alive")
+
+    def __reserve(self, needed):
+        capacity = len(self.ids)
+        if needed <= capacity:
+            return
+        capacity = max(needed, 2 * capacity)
+        for name in self.__columns():
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def append(self, ids, x, y, r):
+        """Append blobs (ids must be larger than any stored id). Returns the new slots."""
+        n = len(ids)
+        self.__reserve(self.size + n)
+        slots = np.arange(self.size, self.size + n)
+        self.ids[slots] = ids
+        self.x[slots] = x
+        self.y[slots] = y
+        self.r[slots] = r
+        self.selected[slots] = False
+        self.alive[slots] = True
+        self.size += n
+        self.count += n
+        return slots
+
+    def slots_of(self, ids):
+        """Map blob ids to their current slots."""
+        return np.searchsorted(self.ids[:self.size], ids)
+
+    def live_slots(self):
+        return np.flatnonzero(self.alive[:self.size])
+
+    def selected_slots(self):
+        return np.flatnonzero(self.selected[:self.size])
+
+    def kill(self, slots):
+        """Tombstone the given slots."""
+        slots = slots[self.alive[slots]]
+        self.alive[slots] = False
+        self.selected[slots] = False
+        self.count -= len(slots)
+        if self.size > 1024 and self.count < self.size // 2:
+            self.compact()
+
+    def compact(self):
+        """Drop tombstoned slots, keeping the remaining blobs in id order."""
+        keep = self.live_slots()
+        for name in self.__columns():
+            column = getattr(self, name)
+            column[:len(keep)] = column[keep]
+        self.size = len(keep)
+        self.epoch += 1
+
+    def clear(self):
+        self.alive[:self.size] = False
+        self.selected[:self.size] = False
+        self.size = 0
+        self.count = 0
+        self.epoch += 1
+
+
+class BlobView:
+    """Handle on one blob in a BlobStore with the same id/x/y/r attributes as Blob."""
+    __slots__ = ("__store", "id", "__slot", "__epoch")
+
+    def __init__(self, store, id, slot):
+        self.__store = store
+        self.id = id
+        self.__slot = slot
+        self.__epoch = store.epoch
+
+    def slot(self):
+        if self.__epoch != self.__store.epoch:
+            self.__slot = int(self.__store.slots_of(self.id))
+            self.__epoch = self.__store.epoch
+        return self.__slot
+
+    @property
+    def x(self):
+        return float(self.__store.x[self.slot()])
+
+    @x.setter
+    def x(self, value):
+        self.__store.x[self.slot()] = value
+
+    @property
+    def y(self):
+        return float(self.__store.y[self.slot()])
+
+    @y.setter
+    def y(self, value):
+        self.__store.y[self.slot()] = value
+
+    @property
+    def r(self):
+        return float(self.__store.r[self.slot()])
+
+    @r.setter
+    def r(self, value):
+        self.__store.r[self.slot()] = value
+
+    def is_alive(self):
+        slot = self.slot()
+        return slot < self.__store.size and self.__store.ids[slot] == self.id and bool(self.__store.alive[slot])
+
+    def __eq__(self, other):
+        return isinstance(other, BlobView) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class BlobListView:
+    """Read-only collection view over the alive (or selected) blobs of a BlobStore."""
+
+    def __init__(self, store, selected_only=False):
+        self.__store = store
+        self.__selected_only = selected_only
+
+    def __slots(self):
+        if self.__selected_only:
+            return self.__store.selected_slots()
+        return self.__store.live_slots()
+
+    def __len__(self):
+        if self.__selected_only:
+            return int(np.count_nonzero(self.__store.selected[:self.__store.size]))
+        return self.__store.count
+
+    def __iter__(self):
+        store = self.__store
+        slots = self.__slots()
+        for slot, id in zip(slots.tolist(), store.ids[slots].tolist()):
+            yield BlobView(store, id, slot)
+
+    def __contains__(self, blob):
+        if not isinstance(blob, BlobView) or not blob.is_alive():
+            return False
+        if self.__selected_only:
+            return bool(self.__store.selected[blob.slot()])
+        return True
@@ -0,0 +1,157 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+
+class DiskCache:
+    def __init__(self, cache_dir=None, max_bytes=4 * 1024 * 1024 * 1024):
+        """
+        Directory of .npy arrays with a size cap. Arrays are memory-mapped when read, and
+        the least recently used files are deleted once the directory grows over the cap.
+        :param cache_dir: Defaults to ~/.cache/pglabeller.
+        :param max_bytes: Total size of the cached files before the oldest are evicted.
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "pglabeller")
+        self.__cache_dir = cache_dir
+        self.__max_bytes = max_bytes
+        self.__entries = {}  # name -> [nbytes, last used time]
+        self.__bytes = 0
+        self.__lock = threading.Lock() # Pyramid levels are written from a background thread too
+        self.__writes = queue.Queue() # (name, array) pairs waiting for the writer thread
+        self.__writer = None
+        if os.path.isdir(cache_dir):
+            for filename in os.listdir(cache_dir):
+                if filename.endswith(".tmp"):
+                    # Left by a write cut short at exit; never indexed, so it would escape the cap
+                    try:
+                        os.remove(os.path.join(cache_dir, filename))
+                    except OSError:
+                        pass
+                elif filename.endswith(".npy"):
+                    stat = os.stat(os.path.join(cache_dir, filename))
+                    self.__entries[filename[:-4]] = [stat.st_size, stat.st_mtime]
+                    self.__bytes += stat.st_size
+
+    def get_cache_dir(self):
+        return self.__cache_dir
+
+    def __path(self, name):
+        return os.path.join(self.__cache_dir, name + ".npy")
+
+    def get(self, name):
+        """Return the array stored under name, read-only and memory-mapped, or None."""
+        with self.__lock:
+            return self.__get(name)
+
+    def __get(self, name):
+        entry = self.__entries.get(name)
+        if entry is None:
+            return None
+        try:
+            array = np.load(self.__path(name), mmap_mode="r")
+        except (OSError, ValueError):
+            # Deleted or truncated behind our back
+            self.__forget(name)
+            return None
+        # The file's mtime records its last use, so the LRU order survives restarts
+        entry[1] = time.time()
+        try:
+            os.utime(self.__path(name), (entry[1], entry[1]))
+        except OSError:
+            pass
+        return array
+
+    def put(self, name, array):
+        """Store an array under name, evicting least recently used files over the cap."""
+        #The file is written without the lock, so gets never wait on a write in progress
+        path = self.__path(name)
+        #Write under a temporary name so a crash never leaves a truncated file behind;
+        #the thread id keeps concurrent writers of one name apart
+        temp_path = "%s.%d.tmp" % (path, threading.get_ident())
+        try:
+            os.makedirs(self.__cache_dir, exist_ok=True)
+            with open(temp_path, "wb") as cache_file:
+                np.save(cache_file, array)
+            nbytes = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+            with self.__lock:
+                self.__forget(name)
+                self.__entries[name] = [nbytes, time.time()]
+                self.__bytes += nbytes
+                self.__evict(keep=name)
+        except OSError as error:
+            print("Could not write to disk cache:", error)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def put_async(self, name, array):
+        """
+        Like put, but the file is written by a background thread so the caller never waits on
+        the disk, e.g. from the Tk thread. array must not change afterwards; a PIL image is
+        converted on the writer thread.
+        """
+        with self.__lock:
+            if self.__writer is None:
+                self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+                self.__writer.start()
+                # Finish queued writes on exit rather than throw the results away
+                atexit.register(self.wait_for_writes)
+        self.__writes.put((name, array))
+
+    def __write_loop(self):
+        while True:
+            name, array = self.__writes.get()
+            self.put(name, np.asarray(array))
+            self.__writes.task_done()
+
+    def wait_for_writes(self):
+        """Block until every put_async so far is on disk."""
+        self.__writes.join()
+
+    def __contains__(self, name):
+        return name in self.__entries
+
+    def __forget(self, name):
+        entry = self.__entries.pop(name, None)
+        if entry is not None:
+            self.__bytes -= entry[0]
+
+    def __evict(self, keep=None):
+        if self.__bytes <= self.__max_bytes:
+            return
+        for name in sorted(self.__entries, key=lambda name: self.__entries[name][1]):
+            if self.__bytes <= self.__max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                # Mapped arrays stay valid after their file is unlinked
+                os.remove(self.__path(name))
+            except OSError:
+                continue
+            self.__forget(name)
+
+    def set_max_bytes(self, max_bytes):
+        with self.__lock:
+            self.__max_bytes = max_bytes
+            self.__evict()
+
+    def get_size_bytes(self):
+        return self.__bytes
+
+    def clear(self):
+        with self.__lock:
+            for name in list(self.__entries):
+                try:
+                    os.remove(self.__path(name))
+                except OSError:
+                    continue
+                self.__forget(name)
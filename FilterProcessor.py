@@ -1,11 +1,21 @@
 import cv2
 import numpy as np
-import math
-from PIL import Image, ImageTk
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image
+from TileCache import TileCache
+from ImagePyramid import ImagePyramid
 
 class FilterProcessor:
-    def __init__(self):
+    def __init__(self, disk_cache=None):
+        """
+        :param disk_cache: Optional DiskCache that filtered images persist in across sessions.
+            Only used for images bound with an image_key.
+        """
         self.__image_mipmap = None
+        # Read-only filtered grayscale for detection and its cache key, independent of the RGB mipmap
+        self.__gray_image = None
+        self.__gray_key = None
         self.__updated = False
         self.__d = 0
         self.__sigma_color = 0
@@ -13,77 +23,257 @@ class FilterProcessor:
         self.__original_image = None
         self.__render_image = None
         self.__shift = None
+        self.__tile_size = 1024 # Core size of the tiles filtered in parallel
+        self.__pool = None # Thread pool for tiled filtering, created on first use
+        # Filtered mipmaps and grayscale arrays keyed by (kind, image identity, d, sigma_color, sigma_space)
+        self.__filter_cache = TileCache(max_bytes=1024 * 1024 * 1024)
+        self.__disk_cache = disk_cache
+        # Levels are built with NEAREST and drawn to the screen with BILINEAR
+        self.__level_resample = Image.NEAREST
+        self.__view_resample = Image.BILINEAR
+        self.__tile_cache = TileCache(max_bytes=128 * 1024 * 1024) # Screen tiles of the filtered mipmaps
+        self.__image_key = None
         
     def get_render(self):
+        """Return (HxWx3 uint8 RGB array of the last render, or None, and its screen shift)."""
         return self.__render_image, self.__shift
 
-    def bind_image(self, image):
+    def bind_image(self, image, image_key=None):
+        """
+        :param image_key: Names the image in the disk cache, e.g. LayerRenderer.get_image_key().
+        """
+        self.__image_key = image_key
+        if image is not self.__original_image:
+            # Results for other images would only pin them in memory
+            self.__filter_cache.clear()
+            self.__tile_cache.clear()
+            self.__gray_image = None
+            self.__gray_key = None
         self.__original_image = image
         self.__updated = True
 
+    def set_max_workers(self, count):
+        """Set how many threads tiled filtering uses. Defaults to one per core."""
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False)
+        self.__pool = ThreadPoolExecutor(max_workers=max(int(count), 1))
 
-    def render(self, orig_top_left, orig_bottom_right, scale):
-        if self.__original_image is None:
-            print("Bind image before rendering")
+    def set_cache_budget(self, max_bytes):
+        """Set how many bytes of filtered images are kept for previously used parameter sets."""
+        self.__filter_cache.set_max_bytes(max_bytes)
+
+    def __cache_key(self, image, params, kind="rgb"):
+        return (kind, id(image)) + tuple(params)
+
+    def __disk_name(self, image, params):
+        # Name of a filtered result in the disk cache, or None if it isn't persisted
+        if self.__disk_cache is None or self.__image_key is None or image is not self.__original_image:
+            return None
+        return "%s-filter-%d-%d-%d" % ((self.__image_key,) + tuple(params))
+
+    def __use_cached(self):
+        # Returning to a previously filtered parameter set installs the cached mipmap
+        if not self.__updated:
             return
+        params = self.get_filter_params()
+        key = self.__cache_key(self.__original_image, params)
+        mipmap = self.__filter_cache.get(key)
+        if mipmap is None:
+            disk_name = self.__disk_name(self.__original_image, params)
+            filtered = None if disk_name is None else self.__disk_cache.get(disk_name + "-rgb")
+            if filtered is None:
+                return
+            mipmap = self.__create_mipmap(filtered, disk_name)
+            self.__filter_cache.put(key, mipmap, mipmap.get_total_bytes())
+        self.__image_mipmap = mipmap
+        self.__updated = False
 
-        if self.__updated:
-            # Apply filter if the image is updated
-            self.__apply_filter()
-            self.__updated = False
-            
-        # Display image using the mipmap
-        total_levels = len(self.__image_mipmap)
+    def get_bound_image(self):
+        return self.__original_image
 
-        if scale >= 1.0:
-            selected_level = 0
-        else:
-            selected_level = min(-int(math.log(scale, 2)), total_levels - 1)
+    def get_filter_params(self):
+        return (self.__d, self.__sigma_color, self.__sigma_space)
 
-        effective_scale = scale * (2 ** selected_level)
-        selected_top_left = [orig_top_left[0] / (2 ** selected_level), orig_top_left[1] / (2 ** selected_level)]
-        selected_bottom_right = [orig_bottom_right[0] / (2 ** selected_level), orig_bottom_right[1] / (2 ** selected_level)]
+    def is_filtered(self):
+        """True when the filtered image matches the bound image and current parameters."""
+        self.__use_cached()
+        return self.__image_mipmap is not None and not self.__updated
 
-        selected_width = self.__image_mipmap[selected_level].width
-        selected_height = self.__image_mipmap[selected_level].height
+    def get_gray_array(self):
+        """
+        Return the filtered grayscale detection image for the bound image and current
+        parameters, or None if it has not been filtered yet. The array is cached and read-only.
+        """
+        key = self.__cache_key(self.__original_image, self.get_filter_params(), "gray")
+        if key != self.__gray_key:
+            self.__gray_image = self.__filter_cache.get(key)
+            disk_name = self.__disk_name(self.__original_image, self.get_filter_params())
+            if self.__gray_image is None and disk_name is not None:
+                self.__gray_image = self.__disk_cache.get(disk_name + "-gray")
+                if self.__gray_image is not None:
+                    self.__filter_cache.put(key, self.__gray_image)
+            self.__gray_key = key if self.__gray_image is not None else None
+        return self.__gray_image
 
-        clamped_top_left = [max(selected_top_left[0], 0), max(selected_top_left[1], 0)]
-        clamped_bottom_right = [
-            min(selected_bottom_right[0], selected_width),
-            min(selected_bottom_right[1], selected_height)
-        ]
+    def filter_image(self, image, params, progress=None, cancelled=None):
+        """
+        Bilateral filter an image. Touches no state, so it can run on a worker thread.
+        Images larger than one tile are filtered tile by tile on a thread pool.
+        :param image: PIL image or RGB array to filter.
+        :param params: (d, sigma_color, sigma_space) as returned by get_filter_params.
+        :param progress: Optional callable taking the fraction of tiles done.
+        :param cancelled: Optional callable, e.g. BackgroundJob.is_cancelled. Once it returns
+            True the tiles not started yet are dropped and None is returned.
+        """
+        image = np.asarray(image)
+        d, sigma_color, sigma_space = params
+        if image.shape[0] <= self.__tile_size and image.shape[1] <= self.__tile_size:
+            return cv2.bilateralFilter(image, d, sigma_color, sigma_space)
+        return self.__filter_tiled(image, d, sigma_color, sigma_space, progress, cancelled)
 
-        shift_x = (clamped_top_left[0] - selected_top_left[0]) * effective_scale
-        shift_y = (clamped_top_left[1] - selected_top_left[1]) * effective_scale
+    def filter_gray(self, image, params, progress=None, cancelled=None):
+        """
+        Convert an image to grayscale and then filter the single channel, for when only
+        the blob detector needs the result. A third of the work of filtering RGB.
+        Touches no state, so it can run on a worker thread.
+        """
+        return self.filter_image(self.to_grayscale(np.asarray(image)), params, progress, cancelled)
 
-        new_width = int((clamped_bottom_right[0] - clamped_top_left[0]) * effective_scale)
-        new_height = int((clamped_bottom_right[1] - clamped_top_left[1]) * effective_scale)
+    def filter_region(self, image, params, region, progress=None, gray=False, cancelled=None):
+        """
+        Bilateral filter only region=(x0, y0, x1, y1) of an image. The region is read with
+        a halo of the filter radius, so the result matches the same crop of the whole image
+        filtered. Touches no state, so it can run on a worker thread.
+        :param gray: Convert the crop to grayscale before filtering, as filter_gray does.
+        """
+        x0, y0, x1, y1 = region
+        width, height = image.size if isinstance(image, Image.Image) else (image.shape[1], image.shape[0])
+        halo = self.__filter_radius(params[0], params[2])
+        hx0, hy0 = max(x0 - halo, 0), max(y0 - halo, 0)
+        hx1, hy1 = min(x1 + halo, width), min(y1 + halo, height)
+        if isinstance(image, Image.Image):
+            crop = np.asarray(image.crop((hx0, hy0, hx1, hy1)))
+        else:
+            crop = image[hy0:hy1, hx0:hx1]
+        if gray:
+            crop = self.to_grayscale(crop)
+        filtered = self.filter_image(crop, params, progress, cancelled)
+        if filtered is None:
+            return None
+        return filtered[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
 
-        if new_width < 1 or new_height < 1:
-            return
+    def __filter_radius(self, d, sigma_space):
+        # Same neighbourhood radius as cv2.bilateralFilter derives from d and sigma_space
+        if sigma_space <= 0:
+            sigma_space = 1
+        radius = d // 2 if d > 0 else int(round(sigma_space * 1.5))
+        return max(radius, 1)
 
-        region_box = (
-            int(clamped_top_left[0]), int(clamped_top_left[1]),
-            int(clamped_bottom_right[0]), int(clamped_bottom_right[1])
-        )
+    def __filter_tiled(self, image, d, sigma_color, sigma_space, progress=None, cancelled=None):
+        """
+        Filter overlapping tiles in parallel. Each tile is read with a halo of the filter
+        radius, so every output pixel sees the same neighbourhood as in the untiled call
+        and the result is identical to cv2.bilateralFilter on the whole image.
+        """
+        if self.__pool is None:
+            self.__pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
 
-        # Correct reference: using __image_mipmap
-        img = self.__image_mipmap[selected_level].crop(region_box)
-        img = img.resize((new_width, new_height), Image.BILINEAR)
+        height, width = image.shape[:2]
+        halo = self.__filter_radius(d, sigma_space)
+        size = self.__tile_size
+        output = np.empty_like(image)
 
-        self.__render_image = ImageTk.PhotoImage(img)
+        def filter_tile(y0, x0):
+            if cancelled is not None and cancelled():
+                return
+            y1, x1 = min(y0 + size, height), min(x0 + size, width)
+            # Grow the tile by the halo, clamped to the image where cv2's own border handling applies
+            hy0, hx0 = max(y0 - halo, 0), max(x0 - halo, 0)
+            hy1, hx1 = min(y1 + halo, height), min(x1 + halo, width)
+            filtered = cv2.bilateralFilter(np.ascontiguousarray(image[hy0:hy1, hx0:hx1]), d, sigma_color, sigma_space)
+            output[y0:y1, x0:x1] = filtered[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
 
-        self.__shift = [shift_x, shift_y]
+        futures = [self.__pool.submit(filter_tile, y0, x0)
+                   for y0 in range(0, height, size) for x0 in range(0, width, size)]
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if cancelled is not None and cancelled():
+                # Free the shared pool for the job that superseded this one
+                for pending in futures:
+                    pending.cancel()
+                return None
+            if progress is not None:
+                progress(done / len(futures))
+        return output
 
+    def to_grayscale(self, image):
+        """Convert an RGB array to the grayscale image the blob detector expects."""
+        return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
 
-    #returns bw image to blob detector    
-    def get_current_image(self):
+    def commit_filtered(self, image, params, filtered):
+        """
+        Install a filtered array computed off-thread by filter_image.
+        Returns False, dropping the result, if the bound image or parameters changed since.
+        """
+        if image is not self.__original_image or params != self.get_filter_params():
+            return False
+        disk_name = self.__disk_name(image, params)
+        if disk_name is not None:
+            # Written on the cache's writer thread, so the Tk thread never waits on the disk
+            self.__disk_cache.put_async(disk_name + "-rgb", filtered)
+        self.__image_mipmap = self.__create_mipmap(filtered, disk_name)
+        self.__updated = False
+        # Account for every level, as the lazy levels fill in while the mipmap is cached
+        self.__filter_cache.put(self.__cache_key(image, params), self.__image_mipmap, self.__image_mipmap.get_total_bytes())
+        return True
+
+    def commit_gray(self, image, params, gray):
+        """
+        Install a detection image computed off-thread by filter_gray.
+        Returns False, dropping the result, if the bound image or parameters changed since.
+        """
+        if image is not self.__original_image or params != self.get_filter_params():
+            return False
+        # Read-only so callers can share the cached array instead of copying it
+        gray.flags.writeable = False
+        self.__gray_key = self.__cache_key(image, params, "gray")
+        self.__gray_image = gray
+        self.__filter_cache.put(self.__gray_key, gray)
+        disk_name = self.__disk_name(image, params)
+        if disk_name is not None:
+            self.__disk_cache.put_async(disk_name + "-gray", gray)
+        return True
+
+
+    def render(self, orig_top_left, orig_bottom_right, scale):
+        if self.__original_image is None:
+            print("Bind image before rendering")
+            return
+
+        self.__use_cached()
         if self.__updated:
+            # Apply filter if the image is updated
             self.__apply_filter()
+            self.__updated = False
+            
+        # Display image using the mipmap
+        selected_level, effective_scale, window, shift = self.__image_mipmap.map_viewport(orig_top_left, orig_bottom_right, scale)
+        self.__shift = shift
+        if window[2] - window[0] < 1 or window[3] - window[1] < 1:
+            self.__render_image = None
+            return
+
+        self.__render_image = self.__image_mipmap.render_window(selected_level, window, effective_scale)
+
 
-        # Convert the top-level image to grayscale using OpenCV
-        gray_image = cv2.cvtColor(np.array(self.__image_mipmap[0]), cv2.COLOR_RGB2GRAY)
-        return gray_image
+    #returns bw image to blob detector    
+    def get_current_image(self):
+        # Detection only needs grayscale, so the RGB filtered image is left for render to build
+        if self.get_gray_array() is None:
+            params = self.get_filter_params()
+            print("applying filter")
+            self.commit_gray(self.__original_image, params, self.filter_gray(self.__original_image, params))
+        return self.get_gray_array()
             
     def set_d(self, value):
         value = int(value)
@@ -106,20 +296,57 @@ class FilterProcessor:
             self.__sigma_space = int(value)
             print("sigma_space ", self.__sigma_space)
         
-    def __create_mipmap(self, image):
-        pyramid = [image]
-        while pyramid[-1].width > 512 and pyramid[-1].height > 512:
-            new_img = pyramid[-1].resize(
-                (pyramid[-1].width // 2, pyramid[-1].height // 2), Image.NEAREST
-            )
-            pyramid.append(new_img)
-        return pyramid
+    def __create_mipmap(self, image, disk_name=None):
+        # Levels are built when a zoom level first needs them, or loaded from the disk cache
+        cache_key = None if disk_name is None else disk_name + "-rgb"
+        return ImagePyramid(image, self.__level_resample, disk_cache=self.__disk_cache, cache_key=cache_key,
+                            view_resample=self.__view_resample, tile_cache=self.__tile_cache)
+
+    def set_resampling(self, level_resample, view_resample=None):
+        """Set the PIL filters used to build levels and to scale them to the screen, for mipmaps built from now on."""
+        self.__level_resample = level_resample
+        self.__view_resample = level_resample if view_resample is None else view_resample
+
+    def get_stats(self):
+        """ImagePyramid.get_stats() of the current filtered mipmap, or None."""
+        if self.__image_mipmap is None:
+            return None
+        return self.__image_mipmap.get_stats()
+
+    def get_resident_levels(self):
+        """Indices of the built levels of the current filtered mipmap."""
+        if self.__image_mipmap is None:
+            return []
+        return self.__image_mipmap.get_resident_levels()
 
     def __apply_filter(self):
         # Apply bilateral filter on the numpy array representation of the original image.
-        processed_image = cv2.bilateralFilter(np.array(self.__original_image), self.__d, self.__sigma_color, self.__sigma_space)
+        params = self.get_filter_params()
+        processed_image = self.filter_image(self.__original_image, params)
         #processed_image = cv2.GaussianBlur(np.array(self.__original_image), (self.__d, self.__sigma_color), self.__sigma_space)
         print("applying filter")
-        # Convert the processed image back to a PIL Image before creating the mipmap.
-        processed_image = Image.fromarray(processed_image)
-        self.__image_mipmap = self.__create_mipmap(processed_image)
+        self.commit_filtered(self.__original_image, params, processed_image)
+
+
+if __name__ == "__main__":
+    # Benchmark: tiled vs untiled bilateral filter on a large synthetic image.
+    import time
+
+    height, width = 6000, 8000
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+    params = (9, 75, 75)
+    processor = FilterProcessor()
+
+    start = time.perf_counter()
+    reference = cv2.bilateralFilter(image, *params)
+    untiled = time.perf_counter() - start
+
+    processor.filter_image(image[:2048, :2048], params)  # Warm up the thread pool
+    start = time.perf_counter()
+    tiled_result = processor.filter_image(image, params)
+    tiled = time.perf_counter() - start
+
+    print("image", width, "x", height, "params", params, "threads", os.cpu_count())
+    print("untiled %.3f s, tiled %.3f s, speedup %.2fx" % (untiled, tiled, untiled / tiled))
+    print("identical output:", np.array_equal(reference, tiled_result))
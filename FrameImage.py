@@ -0,0 +1,59 @@
+import numpy as np
+from PIL import Image, ImageTk
+
+
+class FrameImage:
+    def __init__(self, canvas, tag="IMG"):
+        """
+        Canvas image item showing rendered frames. The item and its PhotoImage persist across
+        frames; each frame is pasted into the PhotoImage in place, which is only reallocated
+        when the frame size changes.
+        :param canvas: The canvas the image lives on.
+        :param tag: Canvas tag given to the image item.
+        """
+        self.__canvas = canvas
+        self.__tag = tag
+        self.__item = None
+        self.__photo = None
+        self.__frame = None # HxWx3 buffer the render is composed into before pasting
+
+    def show(self, pixels, offset, frame_origin, frame_size):
+        """
+        Show a render.
+        :param pixels: HxWx3 uint8 RGB render.
+        :param offset: Where the render's top-left pixel lands, relative to frame_origin.
+        :param frame_origin: Canvas position of the frame's top-left corner.
+        :param frame_size: (width, height) of the frame, normally the viewport plus overscan.
+        """
+        width, height = max(int(frame_size[0]), 1), max(int(frame_size[1]), 1)
+        canvas = self.__canvas
+        if self.__frame is None or self.__frame.shape[:2] != (height, width):
+            self.__frame = np.empty((height, width, 3), dtype=np.uint8)
+            self.__photo = ImageTk.PhotoImage("RGB", (width, height))
+            if self.__item is None:
+                self.__item = canvas.create_image(0, 0, anchor="nw", image=self.__photo, tag=self.__tag)
+                canvas.tag_lower(self.__item) # Keep blob items and the like above the image
+            else:
+                canvas.itemconfig(self.__item, image=self.__photo)
+
+        # The frame sits on whole canvas pixels; the fractional part moves into the render's offset
+        origin_x, origin_y = int(np.floor(frame_origin[0])), int(np.floor(frame_origin[1]))
+        x = int(round(frame_origin[0] - origin_x + offset[0]))
+        y = int(round(frame_origin[1] - origin_y + offset[1]))
+
+        # Clip the render to the frame; what it doesn't cover shows the canvas background
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + pixels.shape[1], width), min(y + pixels.shape[0], height)
+        if x0 > 0 or y0 > 0 or x1 < width or y1 < height:
+            red, green, blue = canvas.winfo_rgb(canvas.cget("bg"))
+            self.__frame[:] = (red >> 8, green >> 8, blue >> 8)
+        if x1 > x0 and y1 > y0:
+            self.__frame[y0:y1, x0:x1] = pixels[y0 - y:y1 - y, x0 - x:x1 - x]
+
+        self.__photo.paste(Image.fromarray(self.__frame))
+        canvas.coords(self.__item, origin_x, origin_y)
+        canvas.itemconfig(self.__item, state="normal")
+
+    def hide(self):
+        if self.__item is not None:
+            self.__canvas.itemconfig(self.__item, state="hidden")
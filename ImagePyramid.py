@@ -0,0 +1,264 @@
+import itertools
+import math
+import threading
+import time
+import cv2
+import numpy as np
+from PIL import Image
+
+# Radius of each PIL filter in source pixels at 1:1, grown by the downscale factor when reducing
+FILTER_SUPPORT = {Image.NEAREST: 0.5, Image.BOX: 0.5, Image.BILINEAR: 1.0, Image.HAMMING: 1.0,
+                  Image.BICUBIC: 2.0, Image.LANCZOS: 3.0}
+
+_pyramid_ids = itertools.count() # Tells apart tiles of different pyramids in a shared TileCache
+
+
+class ImagePyramid:
+    def __init__(self, image, resample=Image.BILINEAR, min_size=512, disk_cache=None, cache_key=None,
+                 view_resample=None, tile_cache=None, tile_size=256):
+        """
+        Mipmap of an image whose levels are built the first time they are used, and the one
+        place viewports are mapped to a level and resampled for display.
+        Level i is level i - 1 halved, so the levels match an eagerly built pyramid.
+        Indexing and len() work like the list of levels it replaces.
+        :param image: Full resolution level 0, a PIL image or an HxWx3 uint8 array. An array,
+            e.g. memory-mapped, is only ever read a region at a time and never copied whole.
+        :param resample: PIL filter used to halve each level.
+        :param min_size: Levels stop once either side would no longer exceed this.
+        :param disk_cache: Optional DiskCache that built levels are saved to and loaded from.
+        :param cache_key: Names image in disk_cache; it must change whenever the pixels do.
+        :param view_resample: PIL filter used to scale a level to the screen, defaults to resample.
+        :param tile_cache: Optional TileCache, possibly shared, that screen tiles are kept in.
+        :param tile_size: Tiles are tile_size x tile_size screen pixels.
+        """
+        self.__resample = resample
+        self.__view_resample = resample if view_resample is None else view_resample
+        if isinstance(image, Image.Image):
+            self.__sizes = [image.size]
+        else:
+            self.__sizes = [(image.shape[1], image.shape[0])]
+        while self.__sizes[-1][0] > min_size and self.__sizes[-1][1] > min_size:
+            width, height = self.__sizes[-1]
+            self.__sizes.append((width // 2, height // 2))
+        self.__levels = [image] + [None] * (len(self.__sizes) - 1)
+        self.__lock = threading.Lock() # Levels may be built by a background thread and the Tk thread
+        self.__background_job = None
+        self.__disk_cache = disk_cache if cache_key is not None else None
+        self.__cache_key = cache_key
+        self.__tile_cache = tile_cache
+        self.__tile_size = tile_size
+        self.__id = next(_pyramid_ids)
+        self.__stats = {"levels_built": 0, "levels_loaded": 0, "build_seconds": 0.0,
+                        "tile_hits": 0, "tile_misses": 0, "tile_seconds": 0.0}
+
+    def __len__(self):
+        return len(self.__sizes)
+
+    def __getitem__(self, level):
+        if level < 0:
+            level += len(self.__sizes)
+        image = self.__levels[level]
+        if image is not None:
+            return image
+        # Build every missing level up to this one from the nearest built level. The lock is
+        # taken per level, so each is published as soon as it is built and a render needing a
+        # low level never waits for a background build of the levels above it
+        for index in range(1, level + 1):
+            if self.__levels[index] is None:
+                with self.__lock:
+                    if self.__levels[index] is None:
+                        self.__levels[index] = self.__load_or_halve(index)
+        return self.__levels[level]
+
+    def __load_or_halve(self, index):
+        start = time.perf_counter()
+        level = None
+        if self.__disk_cache is not None:
+            name = "%s-%d-L%d" % (self.__cache_key, int(self.__resample), index)
+            # Levels saved by an earlier session come back memory-mapped
+            level = self.__disk_cache.get(name)
+        if level is not None:
+            self.__stats["levels_loaded"] += 1
+        else:
+            level = self.__halve(index)
+            if self.__disk_cache is not None:
+                # Written on the cache's writer thread, as levels are often built during a render
+                self.__disk_cache.put_async(name, level)
+            self.__stats["levels_built"] += 1
+        self.__stats["build_seconds"] += time.perf_counter() - start
+        return level
+
+    def __halve(self, index):
+        source = self.__levels[index - 1]
+        if isinstance(source, Image.Image):
+            return source.resize(self.__sizes[index], self.__resample)
+        # Resample an array in bands of rows so it is never copied whole
+        width, height = self.__sizes[index]
+        source_width, source_height = self.__sizes[index - 1]
+        scale_y = source_height / height
+        output = np.empty((height, width, source.shape[2]), dtype=np.uint8)
+        for row in range(0, height, 256):
+            rows = min(256, height - row)
+            box = (0, row * scale_y, source_width, (row + rows) * scale_y)
+            output[row:row + rows] = np.asarray(self.__resize_array(source, (width, rows), box, self.__resample))
+        return Image.fromarray(output)
+
+    def __resize_array(self, array, size, box, resample):
+        # Crop just the pixels the filter reads around box, then let PIL resample the crop
+        support = FILTER_SUPPORT.get(resample, 3.0)
+        scale = max((box[2] - box[0]) / size[0], (box[3] - box[1]) / size[1], 1.0)
+        margin = int(math.ceil(support * scale)) + 1
+        height, width = array.shape[:2]
+        x0, y0 = max(int(math.floor(box[0])) - margin, 0), max(int(math.floor(box[1])) - margin, 0)
+        x1, y1 = min(int(math.ceil(box[2])) + margin, width), min(int(math.ceil(box[3])) + margin, height)
+        crop = Image.fromarray(np.ascontiguousarray(array[y0:y1, x0:x1]))
+        return crop.resize(size, resample, box=(box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0))
+
+    def resize_region(self, level, size, box):
+        """Resample box=(x0, y0, x1, y1) of a level to size, like PIL's resize(size, box=box)."""
+        image = self[level]
+        if isinstance(image, Image.Image):
+            return image.resize(size, self.__view_resample, box=box)
+        return self.__resize_array(image, size, box, self.__view_resample)
+
+    def select_level(self, scale):
+        """Return (level, zoom): the level to draw at scale screen pixels per level 0 pixel, and its own zoom."""
+        if scale >= 1.0:
+            level = 0
+        else:
+            level = min(-int(math.log(scale, 2)), len(self.__sizes) - 1)
+        return level, scale * (2 ** level)
+
+    def map_viewport(self, top_left, bottom_right, scale):
+        """
+        Map a viewport to the level that draws it.
+        :param top_left, bottom_right: Viewport corners in level 0 pixels.
+        :return: (level, zoom, window, shift). window=(u0, v0, u1, v1) is the visible part of the
+            level drawn at zoom, in screen pixels, clamped to the image. shift is where the window's
+            top-left pixel lands on screen relative to top_left.
+        """
+        level, zoom = self.select_level(scale)
+        level_top_left = np.asarray(top_left) / (2 ** level)
+        level_bottom_right = np.asarray(bottom_right) / (2 ** level)
+        width, height = self.__sizes[level]
+        window = (
+            max(int(math.floor(level_top_left[0] * zoom)), 0),
+            max(int(math.floor(level_top_left[1] * zoom)), 0),
+            min(int(math.ceil(level_bottom_right[0] * zoom)), int(width * zoom)),
+            min(int(math.ceil(level_bottom_right[1] * zoom)), int(height * zoom))
+        )
+        shift = [window[0] - level_top_left[0] * zoom, window[1] - level_top_left[1] * zoom]
+        return level, zoom, window, shift
+
+    def render_window(self, level, window, zoom):
+        """Assemble the screen pixel window (u0, v0, u1, v1) of a level drawn at zoom from tiles."""
+        u0, v0, u1, v1 = window
+        size = self.__tile_size
+        width, height = self.__sizes[level]
+        level_size = (int(width * zoom), int(height * zoom))
+        out = None
+        for tile_y in range(v0 // size, (v1 - 1) // size + 1):
+            for tile_x in range(u0 // size, (u1 - 1) // size + 1):
+                tile = self.__get_tile(level, tile_x, tile_y, zoom, level_size)
+                if out is None:
+                    out = np.empty((v1 - v0, u1 - u0) + tile.shape[2:], dtype=np.uint8)
+                # Overlap of this tile with the window, in window coordinates
+                x0, y0 = max(tile_x * size, u0), max(tile_y * size, v0)
+                x1, y1 = min(tile_x * size + tile.shape[1], u1), min(tile_y * size + tile.shape[0], v1)
+                out[y0 - v0:y1 - v0, x0 - u0:x1 - u0] = tile[y0 - tile_y * size:y1 - tile_y * size, x0 - tile_x * size:x1 - tile_x * size]
+        return out
+
+    def render_window_fast(self, level, window, zoom, source_level=None):
+        """
+        Like render_window, but a nearest neighbour resize of the level that skips the tile cache.
+        Far cheaper at zooms that have no tiles yet, for frames that are soon redrawn exactly.
+        :param source_level: Draw from this level instead, e.g. a coarser one that reads fewer pixels.
+        """
+        if source_level is None:
+            source_level = level
+        # A coarser level draws the same window at a proportionally larger zoom
+        zoom = zoom * 2 ** (source_level - level)
+        u0, v0, u1, v1 = window
+        width, height = self.__sizes[source_level]
+        box = (min(int(u0 / zoom), width - 1), min(int(v0 / zoom), height - 1),
+               min(max(int(math.ceil(u1 / zoom)), int(u0 / zoom) + 1), width),
+               min(max(int(math.ceil(v1 / zoom)), int(v0 / zoom) + 1), height))
+        # Within a source pixel of the exact render, which is all a passing frame needs
+        return cv2.resize(self.__crop(source_level, box), (u1 - u0, v1 - v0), interpolation=cv2.INTER_NEAREST)
+
+    def is_window_cached(self, level, window, zoom):
+        """True if every tile render_window needs for the window is in the tile cache."""
+        if self.__tile_cache is None:
+            return False
+        u0, v0, u1, v1 = window
+        size = self.__tile_size
+        return all((self.__id, level, tile_x, tile_y, zoom) in self.__tile_cache
+                   for tile_y in range(v0 // size, (v1 - 1) // size + 1)
+                   for tile_x in range(u0 // size, (u1 - 1) // size + 1))
+
+    def __crop(self, level, box):
+        # Only the box is read, whether the level is a PIL image or a (memory-mapped) array
+        image = self[level]
+        if isinstance(image, Image.Image):
+            return np.asarray(image.crop(box))
+        return image[box[1]:box[3], box[0]:box[2]]
+
+    def __get_tile(self, level, tile_x, tile_y, zoom, level_size):
+        key = (self.__id, level, tile_x, tile_y, zoom)
+        if self.__tile_cache is not None:
+            tile = self.__tile_cache.get(key)
+            if tile is not None:
+                self.__stats["tile_hits"] += 1
+                return tile
+
+        # Tile (tile_x, tile_y) covers screen pixels [tile_x*T, (tile_x+1)*T) of the level drawn at zoom
+        start = time.perf_counter()
+        size = self.__tile_size
+        u0, v0 = tile_x * size, tile_y * size
+        u1, v1 = min(u0 + size, level_size[0]), min(v0 + size, level_size[1])
+        box = (u0 / zoom, v0 / zoom, u1 / zoom, v1 / zoom)
+        tile = np.asarray(self.resize_region(level, (u1 - u0, v1 - v0), box))
+        self.__stats["tile_misses"] += 1
+        self.__stats["tile_seconds"] += time.perf_counter() - start
+        if self.__tile_cache is not None:
+            self.__tile_cache.put(key, tile)
+        return tile
+
+    def get_array(self, level):
+        """A level as an array, without a copy when it is stored as one."""
+        return np.asarray(self[level])
+
+    def get_level_size(self, level):
+        """Size of a level without building it."""
+        return self.__sizes[level]
+
+    def get_resident_levels(self):
+        """Indices of the levels built so far."""
+        return [index for index, image in enumerate(self.__levels) if image is not None]
+
+    def get_resident_bytes(self):
+        return sum(self.__level_bytes(index) for index in self.get_resident_levels())
+
+    def get_total_bytes(self):
+        """Size of the pyramid once every level is built."""
+        return sum(self.__level_bytes(index) for index in range(len(self.__sizes)))
+
+    def __level_bytes(self, index):
+        width, height = self.__sizes[index]
+        level0 = self.__levels[0]
+        bands = len(level0.getbands()) if isinstance(level0, Image.Image) else level0.shape[2]
+        return width * height * bands
+
+    def get_stats(self):
+        """Counters of levels built or loaded from disk and of tile cache use, with the time spent."""
+        stats = dict(self.__stats)
+        stats["resident_levels"] = self.get_resident_levels()
+        stats["resident_bytes"] = self.get_resident_bytes()
+        return stats
+
+    def build_in_background(self):
+        """Build the remaining levels on a daemon thread, e.g. once the first frame is shown."""
+        if self.__background_job is not None or len(self.get_resident_levels()) == len(self.__sizes):
+            return
+        self.__background_job = threading.Thread(target=self.__getitem__, args=(len(self.__sizes) - 1,), daemon=True)
+        self.__background_job.start()
@@ -1,143 +1,219 @@
 import tkinter as tk
 from tkinter import filedialog
-from PIL import Image, ImageTk
-import math
+from PIL import Image
+import cv2
 import numpy as np
 from tkinter import messagebox
+from TileCache import TileCache
+from ImagePyramid import ImagePyramid
+from RawImageCache import RawImageCache
+from DiskCache import DiskCache
 
 
 class LayerRenderer:
-    def __init__(self):
+    def __init__(self, disk_cache=None):
+        """
+        :param disk_cache: DiskCache for decoded images and pyramid levels, defaults to a private one.
+        """
         self.__bg_mipmap = []
         self.__fg_mipmap = []
         self.__blended_render = None
+        self.__blend_buffer = None # Reused output of __blend_layers
+        self.__last_layers = None # (fg crop, bg crop, overlay, overlay origin, scale) of the last render, for reblend
+        self.__progressive = True # Draw new views from a coarser level first, see set_progressive
+        self.__coarse_steps = 2 # How many levels coarser than the selected one progressive frames may come from
+        self.__progressive_min_pixels = 4 * 1024 * 1024 # Level pixels a view must read before it is drawn coarse first
+        self.__needs_refine = False
 
         self.__shift = [0, 0]
-
+        self.__tile_size = 256 # Tiles are tile_size x tile_size screen pixels
+        self.__tile_cache = TileCache() # Shared by the fg and bg pyramids
+        self.__resample = Image.BILINEAR
+        self.__disk_cache = disk_cache if disk_cache is not None else DiskCache()
+        self.__raw_cache = RawImageCache(self.__disk_cache) # Decoded images, memory-mapped on open
+        self.__image_key = None
+
+        # Read-only HxWx3 RGB array of the foreground, usually memory-mapped from the raw cache
         self.current_fg = None
         
     def get_render(self):
+        """Return (HxWx3 uint8 RGB array of the last render, or None, and its screen shift)."""
         return self.__blended_render, self.__shift
 
-    def __build_mipmap(self, image):
-        pyramid = [image]
-        while pyramid[-1].width > 512 and pyramid[-1].height > 512:
-            new_img = pyramid[-1].resize(
-                (pyramid[-1].width // 2, pyramid[-1].height // 2), Image.BILINEAR
-            )
-            pyramid.append(new_img)
-        return pyramid
+    def __build_mipmap(self, image, image_key):
+        # Levels are built when a zoom level first needs them, or loaded from an earlier session
+        return ImagePyramid(image, self.__resample, disk_cache=self.__disk_cache, cache_key=image_key,
+                            tile_cache=self.__tile_cache, tile_size=self.__tile_size)
+
+    def set_resampling(self, resample):
+        """Set the PIL filter used to build levels and scale them to the screen, from the next image loaded."""
+        self.__resample = resample
+
+    def set_progressive(self, enabled, coarse_steps=2):
+        """
+        Turn progressive rendering on or off. When on, a view whose tiles aren't cached is first
+        drawn from a level up to coarse_steps coarser, upscaled with nearest neighbour, and
+        needs_refine() asks for an exact render with refine=True once the app is idle.
+        """
+        self.__progressive = enabled
+        self.__coarse_steps = coarse_steps
+
+    def needs_refine(self):
+        """True if the last render was a coarse progressive frame."""
+        return self.__needs_refine
+
+    def get_stats(self):
+        """Return {layer: ImagePyramid.get_stats()} for the loaded layers."""
+        return {layer: mipmap.get_stats()
+                for layer, mipmap in (("fg", self.__fg_mipmap), ("bg", self.__bg_mipmap)) if mipmap}
+
+    def get_image_key(self):
+        """Disk cache key of the foreground: its file's content hash and modification time."""
+        return self.__image_key
+
+    def prefetch_levels(self):
+        """Build the pyramid levels not used yet on a background thread."""
+        for mipmap in (self.__fg_mipmap, self.__bg_mipmap):
+            if mipmap:
+                mipmap.build_in_background()
+
+    def get_resident_levels(self):
+        """Return {layer: [built level indices]} for the loaded layers."""
+        return {layer: mipmap.get_resident_levels()
+                for layer, mipmap in (("fg", self.__fg_mipmap), ("bg", self.__bg_mipmap)) if mipmap}
 
     def is_fg_loaded(self):
-        return (self.current_fg != None)
+        return (self.current_fg is not None)
+
+    def get_image_size(self):
+        """(width, height) of the foreground."""
+        return self.__fg_mipmap.get_level_size(0)
     
     def load_background(self, filename):
         if not self.__fg_mipmap:
             print("Load the foreground first")
             return
 
-        image = Image.open(filename).convert("RGB")
-        if image.size != self.__fg_mipmap[0].size:
+        image_key = self.__raw_cache.get_image_key(filename)
+        image = self.__raw_cache.load(filename, image_key)
+        if (image.shape[1], image.shape[0]) != self.get_image_size():
             messagebox.showerror("Error", "foreground and background images have different sizes. Resizing background image")
-            image = image.resize(self.__fg_mipmap[0].size, Image.BILINEAR)
+            image = Image.fromarray(image).resize(self.get_image_size(), Image.BILINEAR)
+            image_key = "%s-%dx%d" % ((image_key,) + image.size)
             
 
             
-        self.__bg_mipmap = self.__build_mipmap(image)
+        self.__bg_mipmap = self.__build_mipmap(image, image_key)
+        self.__tile_cache.clear()
+        self.__last_layers = None
 
 
     def load_foreground(self, filename):
-        self.current_fg = Image.open(filename).convert("RGB")
-        self.__fg_mipmap = self.__build_mipmap(self.current_fg)
+        self.__image_key = self.__raw_cache.get_image_key(filename)
+        self.current_fg = self.__raw_cache.load(filename, self.__image_key)
+        self.__fg_mipmap = self.__build_mipmap(self.current_fg, self.__image_key)
         self.__bg_mipmap = []
+        self.__tile_cache.clear()
+        self.__last_layers = None
 
                 
 
-    def __render_foreground(self, region_box, new_width, new_height, mipmap_level):
-        if not self.__fg_mipmap:
-            return
-
-        fg_img = self.__fg_mipmap[mipmap_level].crop(region_box)
-        return fg_img.resize((new_width, new_height), Image.BILINEAR)
-
-    def __render_background(self, region_box, new_width, new_height, mipmap_level):
-        if not self.__bg_mipmap:
-            return
-
-        bg_img = self.__bg_mipmap[mipmap_level].crop(region_box)
-        return bg_img.resize((new_width, new_height), Image.BILINEAR)
-
     def __blend_layers(self, fg, bg, fg_opacity):
-        # Ensure both renders are available.
-        if fg is not None:
-            if bg is not None:
-                bg_np = np.array(bg).astype(np.float32)
-                fg_np = np.array(fg).astype(np.float32)
+        """Blend the uint8 renders into a buffer reused across frames, or return one of them untouched."""
+        if fg is None:
+            return None
+        # Fast paths with nothing to blend
+        if fg_opacity >= 1.0:
+            return fg
+        if bg is not None and fg_opacity <= 0.0:
+            return bg
+
+        if self.__blend_buffer is None or self.__blend_buffer.shape != fg.shape:
+            self.__blend_buffer = np.empty_like(fg)
+        if bg is not None:
+            cv2.addWeighted(fg, fg_opacity, bg, 1.0 - fg_opacity, 0, self.__blend_buffer)
+        else:
+            # Without a background the foreground is blended over black
+            cv2.convertScaleAbs(fg, self.__blend_buffer, fg_opacity)
+        return self.__blend_buffer
+
+    def render(self, orig_top_left, orig_bottom_right, scale, fg_opacity=1.0, overlay=None, fast=False, refine=False):
+        """
+        Render the visible region of the blended layers.
+        :param overlay: Optional OverlayRenderer drawn into the blended image before it is handed to Tk.
+        :param fast: Resize the level with nearest neighbour instead of from tiles, for frames
+            that are replaced by an exact render soon after, e.g. while zooming.
+        :param refine: Render exactly even in progressive mode, replacing a coarse frame.
+        """
         
-                blended_np = bg_np * (1 - fg_opacity) + fg_np * fg_opacity
-                blended_np = np.clip(blended_np, 0, 255).astype(np.uint8)
-                blended_img = Image.fromarray(blended_np)
-                self.__blended_render = ImageTk.PhotoImage(blended_img)
-
-            else:
-                fg_np = np.array(fg).astype(np.float32)
-                blended_np = fg_np * fg_opacity
-                blended_np = np.clip(blended_np, 0, 255).astype(np.uint8)
-                blended_img = Image.fromarray(blended_np)
-                self.__blended_render = ImageTk.PhotoImage(blended_img)
-
-            
-
-    
-    def render(self, orig_top_left, orig_bottom_right, scale, fg_opacity=1.0):
-                
         if not self.__fg_mipmap:
             return
 
-        self.__fg_render = None
-        self.__bg_render = None
         self.__blended_render = None
+        self.__last_layers = None
+        self.__needs_refine = False
         
-        total_levels = len(self.__fg_mipmap)
-
-        if scale >= 1.0:
-            selected_level = 0
-        else:
-            selected_level = min(-int(math.log(scale, 2)), total_levels - 1)
-
-        effective_scale = scale * (2 ** selected_level)
-        selected_top_left = orig_top_left / (2 ** selected_level)
-        selected_bottom_right = orig_bottom_right / (2 ** selected_level)
-
-        selected_width = self.__fg_mipmap[selected_level].width
-        selected_height = self.__fg_mipmap[selected_level].height
-
-        clamped_top_left = [max(selected_top_left[0], 0), max(selected_top_left[1], 0)]
-        clamped_bottom_right = [
-            min(selected_bottom_right[0], selected_width),
-            min(selected_bottom_right[1], selected_height)
-        ]
-
-        shift_x = (clamped_top_left[0] - selected_top_left[0]) * effective_scale
-        shift_y = (clamped_top_left[1] - selected_top_left[1]) * effective_scale
+        # fg and bg are the same size, so one viewport mapping serves both
+        selected_level, effective_scale, window, shift = self.__fg_mipmap.map_viewport(orig_top_left, orig_bottom_right, scale)
+        self.__shift = shift
 
-        self.__shift = [shift_x, shift_y]
-        
-        new_width = int((clamped_bottom_right[0] - clamped_top_left[0]) * effective_scale)
-        new_height = int((clamped_bottom_right[1] - clamped_top_left[1]) * effective_scale)
-
-        if new_width < 1 or new_height < 1:
+        if window[2] - window[0] < 1 or window[3] - window[1] < 1:
             return
 
-        region_box = (
-            int(clamped_top_left[0]), int(clamped_top_left[1]),
-            int(clamped_bottom_right[0]), int(clamped_bottom_right[1])
-        )
-
-        
-        fg_render = self.__render_foreground(region_box, new_width, new_height, selected_level)
-        
-        bg_render = self.__render_background(region_box, new_width, new_height, selected_level)
-        
-        self.__blend_layers(fg_render, bg_render, fg_opacity)
+        coarse = self.__progressive and not fast and not refine and self.__is_slow_window(selected_level, window, effective_scale)
+        fg_render = self.__render_window(self.__fg_mipmap, selected_level, window, effective_scale, fast, coarse)
+
+        bg_render = None
+        if self.__bg_mipmap:
+            bg_render = self.__render_window(self.__bg_mipmap, selected_level, window, effective_scale, fast, coarse)
+        self.__needs_refine = coarse
+
+        # The image's top-left pixel sits at shift screen pixels past orig_top_left
+        self.__last_layers = (fg_render, bg_render, overlay, orig_top_left + np.array(shift) / scale, scale)
+        self.__blended_render = self.__compose(fg_opacity)
+
+    def __render_window(self, mipmap, level, window, zoom, fast, coarse):
+        if coarse:
+            return mipmap.render_window_fast(level, window, zoom, self.__coarse_level(mipmap, level))
+        if fast:
+            return mipmap.render_window_fast(level, window, zoom)
+        return mipmap.render_window(level, window, zoom)
+
+    def __is_slow_window(self, level, window, zoom):
+        # Worth a coarse frame first only if tiles are missing and the level region read is large
+        level_pixels = (window[2] - window[0]) * (window[3] - window[1]) / (zoom * zoom)
+        if level_pixels < self.__progressive_min_pixels:
+            return False
+        return not all(mipmap.is_window_cached(level, window, zoom)
+                       for mipmap in (self.__fg_mipmap, self.__bg_mipmap) if mipmap)
+
+    def __coarse_level(self, mipmap, level):
+        # The coarsest level already built within reach, so the coarse frame never waits on a build
+        resident = [index for index in mipmap.get_resident_levels() if level < index <= level + self.__coarse_steps]
+        return max(resident) if resident else level
+
+    def reblend(self, fg_opacity):
+        """
+        Redo only the blend of the last render at a new opacity, from the fg and bg crops it kept.
+        Returns False if there is no render to reuse, in which case a full render is needed.
+        """
+        if self.__last_layers is None:
+            return False
+        self.__blended_render = self.__compose(fg_opacity)
+        return self.__blended_render is not None
+
+    def __compose(self, fg_opacity):
+        fg_render, bg_render, overlay, overlay_origin, scale = self.__last_layers
+        blended_np = self.__blend_layers(fg_render, bg_render, fg_opacity)
+        if blended_np is None or overlay is None:
+            return blended_np
+
+        if blended_np is fg_render or blended_np is bg_render:
+            # Draw on a copy so the kept crops stay clean for the next reblend
+            if self.__blend_buffer is None or self.__blend_buffer.shape != blended_np.shape:
+                self.__blend_buffer = np.empty_like(blended_np)
+            np.copyto(self.__blend_buffer, blended_np)
+            blended_np = self.__blend_buffer
+        overlay.draw(blended_np, overlay_origin, scale)
+        return blended_np
         
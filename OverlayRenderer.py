@@ -0,0 +1,72 @@
+import cv2
+import numpy as np
+
+
+class OverlayRenderer:
+    def __init__(self, threshold=2000):
+        """
+        Draws blob outlines straight into a rendered viewport image, for scenes with
+        too many visible blobs to keep one canvas item per blob.
+        :param threshold: Visible blob count above which the overlay should be rasterized.
+        """
+        self.__threshold = threshold
+        self.__xs = np.empty(0)
+        self.__ys = np.empty(0)
+        self.__rs = np.empty(0)
+        self.__color = (0, 128, 0)  # Matches the Tk "green" used for canvas ovals
+        self.__thickness = 1
+
+    def set_threshold(self, threshold):
+        self.__threshold = threshold
+
+    def get_threshold(self):
+        return self.__threshold
+
+    def should_rasterize(self, visible_count):
+        return visible_count > self.__threshold
+
+    def set_blobs(self, xs, ys, rs, thickness, color=(0, 128, 0)):
+        """
+        Set the blobs to draw into the next rendered frame.
+        :param xs, ys, rs: Blob centres and radii in original image coordinates.
+        :param thickness: Outline width in original image pixels.
+        :param color: RGB outline colour.
+        """
+        self.__xs, self.__ys, self.__rs = xs, ys, rs
+        self.__thickness = thickness
+        self.__color = color
+
+    def draw(self, image, origin, scale):
+        """
+        Draw the blobs into image in place.
+        :param image: HxWx3 uint8 RGB array of the rendered viewport.
+        :param origin: Original image coordinate of the image's top-left pixel.
+        :param scale: Screen pixels per original image pixel.
+        """
+        if len(self.__xs) == 0:
+            return
+        height, width = image.shape[:2]
+        px = (self.__xs - origin[0]) * scale
+        py = (self.__ys - origin[1]) * scale
+        pr = self.__rs * scale
+
+        # Blobs under a pixel across become single pixels.
+        tiny = pr < 0.5
+        tx = np.floor(px[tiny]).astype(np.int64)
+        ty = np.floor(py[tiny]).astype(np.int64)
+        inside = (tx >= 0) & (tx < width) & (ty >= 0) & (ty < height)
+        image[ty[inside], tx[inside]] = self.__color
+
+        line_width = max(1, int(round(self.__thickness * scale)))
+        px, py, pr = px[~tiny], py[~tiny], pr[~tiny]
+        # Approximate each circle by a closed polygon; bigger circles get more segments.
+        for low, high, segments in ((0.5, 4, 8), (4, 16, 16), (16, np.inf, 32)):
+            group = (pr >= low) & (pr < high)
+            if not group.any():
+                continue
+            angles = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+            gx = px[group, None] + pr[group, None] * np.cos(angles)
+            gy = py[group, None] + pr[group, None] * np.sin(angles)
+            # 4 fractional bits keep sub-pixel centres accurate.
+            points = np.round(np.stack((gx, gy), axis=-1) * 16).astype(np.int32)
+            cv2.polylines(image, points, True, self.__color, line_width, cv2.LINE_8, 4)
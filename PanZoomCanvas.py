@@ -2,10 +2,12 @@ import tkinter as tk
 from tkinter import filedialog
 from PIL import Image, ImageTk
 import math
+import time
 import numpy as np
 
 class PanZoomCanvas(tk.Canvas):
     def __init__(self, parent, **kwargs):
+        kwargs.setdefault("confine", False) # Panning scrolls the view freely, there is no scroll region
         super().__init__(parent, **kwargs)
         self.__scale = 1.0          # Overall zoom factor.
         self.__offset = np.array([0.0, 0.0])  # Offset: canvas coordinate of image’s top-left.
@@ -14,6 +16,17 @@ class PanZoomCanvas(tk.Canvas):
         self.__min_scale = 0.025
         self.__max_scale = 16.0
         self.__prev_size = (self.winfo_width(), self.winfo_height())
+        self.__overscan = 128        # Extra screen pixels rendered on each side so panning can scroll into them.
+        self.__rendered_bounds = None  # Canvas coordinates (x0, y0, x1, y1) covered by the last render.
+        self.__pan_settle_job = None # Pending full re-render once panning pauses.
+        self.__zoom_settle_job = None # Pending exact re-render once zooming pauses.
+        self.__zoom_step = 1.0       # Zoom per wheel notch, as a power of two.
+        self.__fine_zoom_step = 0.25 # Zoom per wheel notch with Ctrl held.
+        self.__redraw_job = None     # Pending coalesced redraw.
+        self.__refine_job = None     # Pending exact render replacing a coarse frame.
+        self.__refining = False      # True while that exact render runs.
+        self.__min_frame_interval = 0.0  # Seconds between renders, 0 means uncapped.
+        self.__last_render_time = 0.0
         self.__register_actions()
         
     def __register_actions(self):
@@ -22,6 +35,7 @@ class PanZoomCanvas(tk.Canvas):
         self.bind("<Button-5>", self.__on_mousewheel)  # Linux scroll down.
         self.bind("<Button-2>", self.__start_pan)        # Middle-click to start panning.
         self.bind("<B2-Motion>", self.__do_pan)          # Drag for panning.
+        self.bind("<ButtonRelease-2>", self.__end_pan)   # Re-render once panning stops.
         
         
     def bind_rendering_system(self, rendering_function):
@@ -91,44 +105,153 @@ class PanZoomCanvas(tk.Canvas):
         visible_width = self.winfo_width()
         visible_height = self.winfo_height()
         if visible_width < 2 or visible_height < 2:
-            self.after(100, self.__redraw_image)
+            self.after(100, self.redraw)
             return
-        # Get visible region in canvas coordinates.
-        top_left = np.array([self.canvasx(0), self.canvasy(0)])
-        bottom_right = np.array([self.canvasx(visible_width), self.canvasy(visible_height)])
+        # Get visible region in canvas coordinates, grown by the pan overscan.
+        top_left = np.array([self.canvasx(0), self.canvasy(0)]) - self.__overscan
+        bottom_right = np.array([self.canvasx(visible_width), self.canvasy(visible_height)]) + self.__overscan
+        self.__rendered_bounds = (top_left[0], top_left[1], bottom_right[0], bottom_right[1])
+        self.__last_render_time = time.perf_counter()
         # Convert to original image coordinates.
         orig_top_left = self.screen_to_orig_image_coord(top_left)
         orig_bottom_right = self.screen_to_orig_image_coord(bottom_right)
         self.__render_callback(orig_top_left, orig_bottom_right, self.__scale)
 
     def redraw(self):
+        """Request a redraw. Requests made before it runs are coalesced into one render."""
+        self.__cancel_refine() # The view changed, so a pending refinement would be stale
+        if self.__redraw_job is not None:
+            return
+        wait = self.__last_render_time + self.__min_frame_interval - time.perf_counter()
+        if wait > 0:
+            self.__redraw_job = self.after(int(wait * 1000) + 1, self.flush_redraw)
+        else:
+            self.__redraw_job = self.after_idle(self.flush_redraw)
+
+    def is_redraw_pending(self):
+        """True while a requested redraw has yet to run."""
+        return self.__redraw_job is not None
+
+    def flush_redraw(self):
+        """Render now, absorbing any pending redraw request."""
+        if self.__redraw_job is not None:
+            self.after_cancel(self.__redraw_job)
+            self.__redraw_job = None
         self.__redraw_image()
+
+    def request_refine(self):
+        """Redraw with is_refining() True once idle, unless another redraw is requested first."""
+        self.__cancel_refine()
+        self.__refine_job = self.after_idle(self.__refine)
+
+    def __cancel_refine(self):
+        if self.__refine_job is not None:
+            self.after_cancel(self.__refine_job)
+            self.__refine_job = None
+
+    def __refine(self):
+        self.__refine_job = None
+        if self.__redraw_job is not None:
+            self.after_cancel(self.__redraw_job)
+            self.__redraw_job = None
+        self.__refining = True
+        try:
+            self.__redraw_image()
+        finally:
+            self.__refining = False
+
+    def is_refining(self):
+        """True while rendering the exact frame that replaces a coarse or mid-zoom one."""
+        return self.__refining
+
+    def set_max_fps(self, fps):
+        """Cap how often coalesced redraws run. None or 0 removes the cap."""
+        self.__min_frame_interval = 1.0 / fps if fps else 0.0
+
+    def set_pan_overscan(self, pixels):
+        """Set how many screen pixels are rendered beyond each edge of the view for fast panning."""
+        self.__overscan = pixels
+
+    def get_visible_region(self):
+        """Return the (top_left, bottom_right) original image coordinates currently on screen."""
+        top_left = self.view_origin()
+        bottom_right = top_left + np.array([self.winfo_width(), self.winfo_height()])
+        return self.screen_to_orig_image_coord(top_left), self.screen_to_orig_image_coord(bottom_right)
+
+    def view_origin(self):
+        """Canvas coordinate shown at the top-left corner of the widget."""
+        return np.array([self.canvasx(0), self.canvasy(0)])
+
+    def __is_view_rendered(self):
+        if self.__rendered_bounds is None:
+            return False
+        x0, y0, x1, y1 = self.__rendered_bounds
+        return (self.canvasx(0) >= x0 and self.canvasy(0) >= y0 and
+                self.canvasx(self.winfo_width()) <= x1 and self.canvasy(self.winfo_height()) <= y1)
                 
     def __on_mousewheel(self, event):
-        if event.num == 5 or event.delta == -120:
-            scale_factor = 0.5 if self.__scale > self.__min_scale else 1.0
-        elif event.num == 4 or event.delta == 120:
-            scale_factor = 2.0 if self.__scale < self.__max_scale else 1.0
+        if event.num == 4:
+            notches = 1.0
+        elif event.num == 5:
+            notches = -1.0
         else:
-            scale_factor = 1.0
-        if scale_factor != 1.0:
-            screen_coord = np.array([self.canvasx(event.x), self.canvasy(event.y)])
-            orig_coord = self.screen_to_orig_image_coord(screen_coord)
-            self.__scale *= scale_factor
-            self.__offset = orig_coord * self.__scale - screen_coord
-            self.__redraw_image()
+            notches = event.delta / 120.0 # Trackpads report fractions of a notch
+        step = self.__fine_zoom_step if event.state & 0x0004 else self.__zoom_step # 0x0004 is Ctrl
+        if notches == 0 or (notches < 0 and self.__scale <= self.__min_scale) or (notches > 0 and self.__scale >= self.__max_scale):
+            return
+
+        exponent = math.log2(self.__scale) + notches * step
+        exponent = min(max(exponent, math.log2(self.__min_scale)), math.log2(self.__max_scale))
+        if abs(exponent - round(exponent)) < 1e-6:
+            exponent = round(exponent) # Land exactly on powers of two, where levels are drawn 1:1
+        screen_coord = np.array([self.canvasx(event.x), self.canvasy(event.y)])
+        orig_coord = self.screen_to_orig_image_coord(screen_coord)
+        self.__scale = 2.0 ** exponent
+        self.__offset = orig_coord * self.__scale - screen_coord
+        # Frames drawn mid-zoom are approximate; the exact one follows once zooming pauses
+        if self.__zoom_settle_job is not None:
+            self.after_cancel(self.__zoom_settle_job)
+        self.__zoom_settle_job = self.after(150, self.__settle_zoom)
+        self.redraw()
+
+    def __settle_zoom(self):
+        self.__zoom_settle_job = None
+        self.request_refine() # Straight to the exact frame, not another coarse one
+
+    def is_zooming(self):
+        """True from a wheel zoom until zooming pauses, while renders may trade accuracy for speed."""
+        return self.__zoom_settle_job is not None
 
     def __start_pan(self, event):
         self.__pan_start = (event.x, event.y)
+        self.scan_mark(event.x, event.y)
 
     def __do_pan(self, event):
         if self.__pan_start is None:
             return
-        dx = event.x - self.__pan_start[0]
-        dy = event.y - self.__pan_start[1]
-        self.__pan_start = (event.x, event.y)
-        self.__offset += np.array([-dx, -dy])
-        self.__redraw_image()
+        # Scroll the view over the items already on the canvas. The offset is left alone,
+        # so image and blob items keep their canvas coordinates.
+        self.scan_dragto(event.x, event.y, gain=1)
+        if not self.__is_view_rendered():
+            self.redraw()
+        if self.__pan_settle_job is not None:
+            self.after_cancel(self.__pan_settle_job)
+        self.__pan_settle_job = self.after(150, self.__settle_pan)
+
+    def __end_pan(self, event):
+        if self.__pan_start is None:
+            return
+        self.__pan_start = None
+        self.__settle_pan()
+
+    def __settle_pan(self):
+        if self.__pan_settle_job is not None:
+            self.after_cancel(self.__pan_settle_job)
+            self.__pan_settle_job = None
+        # Re-centre the rendered area on the view so the overscan is available in every direction.
+        centred_bounds = tuple(self.view_origin() - self.__overscan)
+        if self.__rendered_bounds is None or self.__rendered_bounds[:2] != centred_bounds:
+            self.redraw()
 
     def on_resize(self, event):
         #check if the window is actually resized
@@ -136,7 +259,7 @@ class PanZoomCanvas(tk.Canvas):
         new_size = (self.winfo_width(), self.winfo_height())
         if new_size != self.__prev_size:
             self.__prev_size = new_size
-            self.__redraw_image()
+            self.redraw()
         
     def screen_to_orig_image_coord(self, screen_coord):
         return (screen_coord + self.__offset) / self.__scale
@@ -151,6 +274,6 @@ class PanZoomCanvas(tk.Canvas):
         k = int(np.log2(scale))-1
         self.__scale = 2**k 
         self.__scale = np.clip(self.__scale, self.__min_scale, self.__max_scale)
-        self.__offset = np.array([(image_width*self.__scale-visible_width)/2, (image_height*self.__scale-visible_height)/2])
+        self.__offset = np.array([(image_width*self.__scale-visible_width)/2, (image_height*self.__scale-visible_height)/2]) - self.view_origin()
         self.__pan_start = None
-        self.__redraw_image()
+        self.redraw()
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+"""
+Headless batch blob detection. Filters and detects blobs in every image of a directory
+with one parameter set and writes one <image file name>.csv of blobs per image,
+e.g. a.jpg.csv for a.jpg.
+
+    python3 PgBatch.py images/ out/ --d 5 --min-area 100 --max-area 1000
+
+Images that already have a blob file are skipped, so an interrupted run resumes where
+it stopped. Timings per image are appended to out/batch_log.csv.
+"""
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+from FilterProcessor import FilterProcessor
+from BlobDetector import BlobDetector
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+LOG_NAME = "batch_log.csv"
+PARAMS_NAME = "batch_params.json"
+
+#Per process state, set up once by _init_worker
+_filter_processor = None
+_blob_detector = None
+_filter_params = None
+_detector_params = None
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description="Detect blobs in every image of a directory without the GUI.")
+    parser.add_argument("input_dir", help="Directory of images to process")
+    parser.add_argument("output_dir", help="Directory the blob files are written to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--overwrite", action="store_true", help="Reprocess images that already have a blob file")
+
+    #Defaults match the GUI's right panel
+    parser.add_argument("--d", type=int, default=5)
+    parser.add_argument("--sigma-color", type=int, default=75)
+    parser.add_argument("--sigma-space", type=int, default=75)
+    parser.add_argument("--no-color-filter", action="store_true")
+    parser.add_argument("--blob-color", type=int, default=255, help="0 for dark blobs, 255 for light blobs")
+    parser.add_argument("--no-area-filter", action="store_true")
+    parser.add_argument("--min-area", type=float, default=100)
+    parser.add_argument("--max-area", type=float, default=1000)
+    parser.add_argument("--no-inertia-filter", action="store_true")
+    parser.add_argument("--min-inertia", type=float, default=0.001)
+    parser.add_argument("--max-inertia", type=float, default=1.0)
+    parser.add_argument("--no-circularity-filter", action="store_true")
+    parser.add_argument("--min-circularity", type=float, default=0.001)
+    parser.add_argument("--max-circularity", type=float, default=1.0)
+    parser.add_argument("--no-convexity-filter", action="store_true")
+    parser.add_argument("--min-convexity", type=float, default=0.001)
+    parser.add_argument("--max-convexity", type=float, default=1.0)
+    parser.add_argument("--min-threshold", type=int, default=0)
+    parser.add_argument("--max-threshold", type=int, default=255)
+    parser.add_argument("--min-dist", type=float, default=1)
+    return parser
+
+
+def get_parameter_set(args):
+    """The filter and detector settings of a run, as a JSON friendly dict."""
+    return {
+        "filter": [args.d, args.sigma_color, args.sigma_space],
+        "color": [not args.no_color_filter, args.blob_color],
+        "area": [not args.no_area_filter, args.min_area, args.max_area],
+        "inertia": [not args.no_inertia_filter, args.min_inertia, args.max_inertia],
+        "circularity": [not args.no_circularity_filter, args.min_circularity, args.max_circularity],
+        "convexity": [not args.no_convexity_filter, args.min_convexity, args.max_convexity],
+        "threshold": [args.min_threshold, args.max_threshold],
+        "min_dist": args.min_dist,
+    }
+
+
+def _init_worker(parameter_set, threads):
+    global _filter_processor, _blob_detector, _filter_params, _detector_params
+    _filter_processor = FilterProcessor()
+    _blob_detector = BlobDetector()
+    #Split the cores between processes rather than every process using them all
+    _filter_processor.set_max_workers(threads)
+    _blob_detector.set_max_workers(threads)
+
+    _blob_detector.set_color_params(*parameter_set["color"])
+    _blob_detector.set_area_params(*parameter_set["area"])
+    _blob_detector.set_inertia_params(*parameter_set["inertia"])
+    _blob_detector.set_circularity_params(*parameter_set["circularity"])
+    _blob_detector.set_convexity_params(*parameter_set["convexity"])
+    _blob_detector.set_threshold_params(*parameter_set["threshold"])
+    _blob_detector.set_min_distance_param(parameter_set["min_dist"])
+    _filter_params = tuple(parameter_set["filter"])
+    _detector_params = _blob_detector.snapshot_params()
+
+
+def process_image(image_path, blob_path):
+    """Filter and detect one image and write its blob file. Runs in a worker process."""
+    start = time.perf_counter()
+    image = Image.open(image_path).convert("RGB")
+    loaded = time.perf_counter()
+    gray = _filter_processor.filter_gray(image, _filter_params)
+    filtered_time = time.perf_counter()
+    xs, ys, rs = _blob_detector.find_blobs(_detector_params, gray)
+    detected = time.perf_counter()
+
+    #Write to a temporary file first so an interrupted run never leaves a partial blob file behind
+    temp_path = blob_path + ".tmp"
+    try:
+        with open(temp_path, "w", newline="") as blob_file:
+            writer = csv.writer(blob_file)
+            writer.writerow(["id", "x", "y", "r"])
+            for blob_id, (x, y, r) in enumerate(zip(xs.tolist(), ys.tolist(), rs.tolist())):
+                writer.writerow([blob_id, "%.3f" % x, "%.3f" % y, "%.3f" % r])
+        os.replace(temp_path, blob_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finished = time.perf_counter()
+
+    return {
+        "image": os.path.basename(image_path),
+        "pixels": image.width * image.height,
+        "blobs": len(xs),
+        "load_s": loaded - start,
+        "filter_s": filtered_time - loaded,
+        "detect_s": detected - filtered_time,
+        "total_s": finished - start,
+    }
+
+
+def list_images(input_dir):
+    names = sorted(name for name in os.listdir(input_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+    return [os.path.join(input_dir, name) for name in names]
+
+
+def get_blob_path(output_dir, image_path):
+    #The whole file name, extension included, so a.jpg and a.png don't share a blob file
+    return os.path.join(output_dir, os.path.basename(image_path) + ".csv")
+
+
+def check_parameter_set(output_dir, parameter_set, overwrite):
+    """
+    Record the parameter set in the output directory. Returns False if the directory
+    holds results of a different parameter set, which resuming would silently mix in.
+    """
+    params_path = os.path.join(output_dir, PARAMS_NAME)
+    if os.path.exists(params_path) and not overwrite:
+        with open(params_path) as params_file:
+            if json.load(params_file) != parameter_set:
+                return False
+    with open(params_path, "w") as params_file:
+        json.dump(parameter_set, params_file, indent=2)
+    return True
+
+
+def run(args):
+    if not os.path.isdir(args.input_dir):
+        print("Input directory not found:", args.input_dir)
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    parameter_set = get_parameter_set(args)
+    if not check_parameter_set(args.output_dir, parameter_set, args.overwrite):
+        print("Output directory was made with different parameters. Use --overwrite or another output directory.")
+        return 1
+
+    images = list_images(args.input_dir)
+    pending = [path for path in images
+               if args.overwrite or not os.path.exists(get_blob_path(args.output_dir, path))]
+    print("%d images, %d already done, %d to process" % (len(images), len(images) - len(pending), len(pending)))
+    if not pending:
+        return 0
+
+    workers = max(min(args.workers, len(pending)), 1)
+    threads = max((os.cpu_count() or 1) // workers, 1)
+    log_path = os.path.join(args.output_dir, LOG_NAME)
+    columns = ["image", "pixels", "blobs", "load_s", "filter_s", "detect_s", "total_s"]
+    write_header = not os.path.exists(log_path)
+
+    done = 0
+    failed = 0
+    total_blobs = 0
+    total_pixels = 0
+    start = time.perf_counter()
+    with open(log_path, "a", newline="") as log_file, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                initargs=(parameter_set, threads)) as pool:
+        log = csv.DictWriter(log_file, fieldnames=columns)
+        if write_header:
+            log.writeheader()
+
+        futures = {pool.submit(process_image, path, get_blob_path(args.output_dir, path)): path for path in pending}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                failed += 1
+                print("Failed", futures[future], ":", error)
+                continue
+            done += 1
+            total_blobs += result["blobs"]
+            total_pixels += result["pixels"]
+            log.writerow({key: ("%.3f" % value if key.endswith("_s") else value) for key, value in result.items()})
+            log_file.flush()
+            print("[%d/%d] %s: %d blobs, filter %.2f s, detect %.2f s, total %.2f s" % (
+                done + failed, len(pending), result["image"], result["blobs"],
+                result["filter_s"], result["detect_s"], result["total_s"]))
+
+    elapsed = time.perf_counter() - start
+    print("Processed %d images (%d failed) in %.1f s with %d processes x %d threads" % (done, failed, elapsed, workers, threads))
+    if done and elapsed > 0:
+        print("Throughput: %.2f images/s, %.1f megapixels/s, %d blobs" % (
+            done / elapsed, total_pixels / elapsed / 1e6, total_blobs))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(run(create_arg_parser().parse_args()))
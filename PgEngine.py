@@ -8,6 +8,8 @@ from FilterProcessor import FilterProcessor
 from BlobManager import BlobManager
 from SceneEdit import SceneEdit
 from SceneLabel import SceneLabel
+from BackgroundWorker import BackgroundWorker
+from DiskCache import DiskCache
 from tkinter import filedialog 
 import os
 
@@ -22,14 +24,16 @@ class PgEngine(tk.Tk):
         self.__create_menu_bar()
 
         #Data shared by all the scenes
-        self.layer_renderer = LayerRenderer()
-        self.filter_processor = FilterProcessor()
+        self.disk_cache = DiskCache() #Decoded images, pyramids and filtered images kept between sessions
+        self.layer_renderer = LayerRenderer(self.disk_cache)
+        self.filter_processor = FilterProcessor(self.disk_cache)
         self.filter_processor.bind_image(self.layer_renderer.current_fg)
         self.blob_manager = BlobManager()
+        self.background_worker = BackgroundWorker(self) #Filtering and detection off the Tk thread
 
 
         self.layer_renderer.load_foreground("./images/BlobTest.jpg")
-        self.filter_processor.bind_image(self.layer_renderer.current_fg)
+        self.filter_processor.bind_image(self.layer_renderer.current_fg, self.layer_renderer.get_image_key())
 
 
         
@@ -38,6 +42,8 @@ class PgEngine(tk.Tk):
         self.add_scene("scene_edit", SceneEdit(self))
         self.add_scene("scene_label", SceneLabel(self))
         self.change_scene("scene_edit")
+        #Build the zoom levels not shown yet once the first frame is drawn
+        self.after_idle(self.layer_renderer.prefetch_levels)
 
         self.grid_rowconfigure(0, weight=1)
         self.grid_columnconfigure(0, weight=1)
@@ -185,15 +191,19 @@ class PgEngine(tk.Tk):
             filename,_ = os.path.splitext(os.path.basename(filepath))
             self.title(filename +" ["+filepath+"]"+" -PgLabeller")
 
+            #Results for the previous image are no longer wanted
+            self.background_worker.cancel()
             self.layer_renderer.load_foreground(filepath)
-            self.filter_processor.bind_image(self.layer_renderer.current_fg)
+            self.filter_processor.bind_image(self.layer_renderer.current_fg, self.layer_renderer.get_image_key())
 
             self.blob_manager.reset()
             #Fit the image to the screen
             for scene in self.scene_map.values():
+                scene.on_image_loaded()
                 scene.fit_to_screen()
 
             self.scene_map[self.current_scene].show()
+            self.after_idle(self.layer_renderer.prefetch_levels)
             
 
     def load_background(self):
@@ -203,6 +213,7 @@ class PgEngine(tk.Tk):
         if filepath:
             self.layer_renderer.load_background(filepath)
             self.scene_map[self.current_scene].show()
+            self.after_idle(self.layer_renderer.prefetch_levels)
 
             
     #Only saves image for now. Will later save .pg file 
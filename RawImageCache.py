@@ -0,0 +1,45 @@
+import hashlib
+import os
+import numpy as np
+from PIL import Image
+from DiskCache import DiskCache
+
+
+class RawImageCache:
+    def __init__(self, disk_cache=None):
+        """
+        Decodes each image once into an uncompressed .npy file and memory-maps it on
+        every later open, so pixels are paged in by the OS as they are read instead of
+        being decoded and held in memory.
+        :param disk_cache: DiskCache the decoded images go to, defaults to a private one.
+        """
+        if disk_cache is None:
+            disk_cache = DiskCache()
+        self.__disk_cache = disk_cache
+
+    def get_image_key(self, filepath):
+        """Cache key of an image file: a hash of its content plus its modification time."""
+        digest = hashlib.sha1()
+        with open(filepath, "rb") as image_file:
+            for chunk in iter(lambda: image_file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return "%s-%d" % (digest.hexdigest()[:20], os.stat(filepath).st_mtime_ns)
+
+    def load(self, filepath, image_key=None):
+        """
+        Return the image at filepath as a read-only HxWx3 uint8 RGB array, memory-mapped
+        from the cache. Falls back to the decoded array if the cache can't be written.
+        :param image_key: get_image_key(filepath), if the caller already has it.
+        """
+        if image_key is None:
+            image_key = self.get_image_key(filepath)
+        name = image_key + "-raw"
+        image = self.__disk_cache.get(name)
+        if image is not None:
+            return image
+
+        image = np.asarray(Image.open(filepath).convert("RGB"))
+        if not self.__disk_cache.put(name, image):
+            return image
+        del image
+        return self.__disk_cache.get(name)
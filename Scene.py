@@ -30,5 +30,9 @@ class Scene(tk.Frame):
     def set_canvas_bg(self, canvas_bkg):
         self.canvas.configure(bg=canvas_bkg)
 
+    def on_image_loaded(self):
+        """Called when a new foreground image replaces the current one."""
+        pass
+
     def fit_to_screen(self):
-        self.canvas.reset(self.master.layer_renderer.current_fg.width, self.master.layer_renderer.current_fg.height)
+        self.canvas.reset(*self.master.layer_renderer.get_image_size())
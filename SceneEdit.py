@@ -5,6 +5,9 @@ from PIL import Image, ImageTk, ImageDraw
 import numpy as np
 from BlobDetector import BlobDetector
 from BlobManager import BlobManager
+from BlobOverlay import BlobOverlay
+from OverlayRenderer import OverlayRenderer
+from FrameImage import FrameImage
 
 from LayerRenderer import LayerRenderer
 from FilterProcessor import FilterProcessor
@@ -37,6 +40,10 @@ class SceneEdit(Scene):
         self.__blob_detector.bind_filter_processor(self.master.filter_processor)
         self.__use_filter_renderer = False #bool to choose what will be rendered on canvas
         self.__draw_blobs = True
+        self.__blob_overlay = BlobOverlay(self.canvas) #Persistent ovals for the blob layer
+        self.__overlay_renderer = OverlayRenderer() #Draws blobs into the image when too many are visible
+        self.__frame_image = FrameImage(self.canvas) #One image item and PhotoImage reused by every frame
+        self.__last_frame = None #(frame_origin, frame_size) of the last layer render, reused by opacity changes
         #self.__current_tool = "draw tool"
         self.__centre = np.array([0,0]) #new blob center
         self.__radius = 0 #new blob radius
@@ -44,6 +51,7 @@ class SceneEdit(Scene):
         self.__ctrl_pressed = False
         self.__draw_selection_rect = False
         self.__current_tool = "Cursor"
+        self.__last_box = None #Last box selection, usable as a detection region
         #self.__select_cursor_tool()
         
          
@@ -106,7 +114,10 @@ class SceneEdit(Scene):
 
         self.__right_widget_manager.add_widget("total_blobs", ttk.Label, text="Total Blobs: 0", style = "Bold.TLabel")
         self.__right_widget_manager.add_widget("selected_blobs", ttk.Label, text="Selected Blobs: 0", style = "Bold.TLabel")
+        self.__right_widget_manager.add_widget("detect_region", ttk.Combobox, values=["Whole Image", "View", "Selection Box"], style="Pg.TCombobox")
+        self.__right_widget_manager.get_widget("detect_region").current(0)
         self.__right_widget_manager.add_widget("detect_blobs", ttk.Button, text="Detect Blobs", command=self.__detect_blobs, style="Pg.TButton")
+        self.__right_widget_manager.add_widget("detect_progress", ttk.Progressbar, mode="determinate", maximum=1.0, length=150)
         
         #Filter options
         self.__right_widget_manager.add_widget("filter_parameters", ttk.Label, text="Filter Parameters", style = "Bold.TLabel")
@@ -174,13 +185,9 @@ class SceneEdit(Scene):
         x1 = max(self.__start_pos[0], self.__rect_end[0])
         y0 = min(self.__start_pos[1], self.__rect_end[1])
         y1 = max(self.__start_pos[1], self.__rect_end[1])
+        self.__last_box = (x0, y0, x1, y1)
             
-        for blob in self.master.blob_manager.get_blobs():
-            blob_center = [blob.x, blob.y]  
-            radius = blob.r  
-            
-            if((blob_center[0] + radius <= x1) and (blob_center[0] - radius >= x0) and (blob_center[1] + radius <= y1) and (blob_center[1] - radius >= y0)):
-                self.master.blob_manager.select_blob(blob)
+        self.master.blob_manager.select_blobs(self.master.blob_manager.query_rect(x0, y0, x1, y1))
 
 
         self.__draw_selection_rect = False
@@ -230,12 +237,8 @@ class SceneEdit(Scene):
         self.__ctrl_pressed = False
         
     def __draw_new_blob(self):
-        self.canvas.delete("newBlobLayer")
-        
-        if not self.master.layer_renderer.is_fg_loaded():
-            return
-        
-        if self.__radius == 0:
+        if not self.master.layer_renderer.is_fg_loaded() or self.__radius == 0:
+            self.canvas.delete("newBlobLayer")
             return
                 
         thickness = self.master.blob_manager.get_thickness()
@@ -246,7 +249,12 @@ class SceneEdit(Scene):
         x0, y0 = self.canvas.orig_image_to_screen(p0)
         x1, y1 = self.canvas.orig_image_to_screen(p1)
         
-        self.canvas.create_oval(x0, y0, x1, y1, outline=color, width=thickness, tag="newBlobLayer")
+        #Move the existing preview on mouse motion instead of re-creating it
+        preview = self.canvas.find_withtag("newBlobLayer")
+        if preview:
+            self.canvas.coords(preview[0], x0, y0, x1, y1)
+        else:
+            self.canvas.create_oval(x0, y0, x1, y1, outline=color, width=thickness, tag="newBlobLayer")
 
         
     def __handle_mouse_movement(self, cx, cy):
@@ -271,10 +279,13 @@ class SceneEdit(Scene):
 
 
     def __draw_selection_box(self):
-        self.canvas.delete("RectLayer")
         p0 = self.canvas.orig_image_to_screen(np.array(self.__start_pos))
         p1 = self.canvas.orig_image_to_screen(np.array(self.__rect_end))
-        rect_id = self.canvas.create_rectangle(p0[0], p0[1], p1[0], p1[1],outline="green", dash=(4, 8), width=5, tag="RectLayer")
+        rect = self.canvas.find_withtag("RectLayer")
+        if rect:
+            self.canvas.coords(rect[0], p0[0], p0[1], p1[0], p1[1])
+        else:
+            self.canvas.create_rectangle(p0[0], p0[1], p1[0], p1[1],outline="green", dash=(4, 8), width=5, tag="RectLayer")
 
         
     def __sDrag(self, cx, cy):
@@ -288,24 +299,18 @@ class SceneEdit(Scene):
         
         if self.__is_dragging:
             del_pos = [mouse_pos[0] - self.__start_pos[0], mouse_pos[1] - self.__start_pos[1]]
-            thickness = self.master.blob_manager.get_thickness()
-            
-            for selected_blob in self.master.blob_manager.get_selected_blobs():
-                blob_center = [selected_blob.x, selected_blob.y] 
-                radius = selected_blob.r  
-            
-                selected_blob.x += del_pos[0]
-                selected_blob.y += del_pos[1]
+            self.master.blob_manager.move_selected_blobs(del_pos[0], del_pos[1])
 
   
             self.__start_pos = mouse_pos
+            #Coalesced with the other motion events of this frame
+            self.canvas.redraw()
             
         else:
+            #Only the rubber band changes, the image and blobs stay as they are
             self.__draw_selection_rect = True
             self.__rect_end = mouse_pos
-            #self.canvas.create_oval(x0, y0, x1, y1, outline=color, width=thickness*scale, tag="BlobLayer")
-
-        self.canvas.redraw()
+            self.__draw_selection_box()
             
     def __reset_drawing(self, cx, cy):
         if self.__current_tool.lower() == "cursor":
@@ -333,7 +338,7 @@ class SceneEdit(Scene):
         clicked_bkg = True
         self.__is_dragging = False
         
-        for blob in self.master.blob_manager.get_blobs():
+        for blob in self.master.blob_manager.query_point(mouse_pos[0], mouse_pos[1], half_thickness):
             blob_center = [blob.x, blob.y]  
             radius = blob.r  
             
@@ -365,37 +370,70 @@ class SceneEdit(Scene):
     def __sRender(self, orig_top_left, orig_bottom_right, scale):
         if not self.master.layer_renderer.is_fg_loaded():
             return
-
-        self.canvas.delete("IMG")
         
         
-        scale_label = str(scale) + " X"
+        scale_label = "%.3g X" % scale
         self.__bottom_widget_manager.get_widget("scale").config(text=scale_label)
         
         
-        if self.__use_filter_renderer:
+        #The filtered view falls back to the plain image until the background filter is done
+        show_filtered = self.__use_filter_renderer and self.__request_filtered_image()
+
+        visible_blobs = None
+        rasterize_blobs = False
+        if not show_filtered:
+            visible_blobs = self.__cull_blobs(orig_top_left, orig_bottom_right)
+        if visible_blobs is not None and self.__overlay_renderer.should_rasterize(len(visible_blobs[0])):
+            #Unselected blobs get drawn into the image, selected ones stay canvas items
+            rasterize_blobs = True
+            ids, xs, ys, rs, selected = visible_blobs
+            self.__overlay_renderer.set_blobs(xs[~selected], ys[~selected], rs[~selected], self.master.blob_manager.get_thickness())
+
+        if show_filtered:
             self.master.filter_processor.render(orig_top_left, orig_bottom_right, scale)
             current_render, shift = self.master.filter_processor.get_render()
         else:
-            self.master.layer_renderer.render(orig_top_left, orig_bottom_right, scale, self.fg_opacity)   
+            overlay = self.__overlay_renderer if rasterize_blobs else None
+            self.master.layer_renderer.render(orig_top_left, orig_bottom_right, scale, self.fg_opacity, overlay,
+                                              fast=self.canvas.is_zooming(), refine=self.canvas.is_refining())
             current_render, shift = self.master.layer_renderer.get_render()
+            if self.master.layer_renderer.needs_refine():
+                self.canvas.request_refine() #Coarse frame now, the exact one once idle
             
+        self.__last_frame = None
         if current_render is None:
+            self.__frame_image.hide()
             return
         
         
-        self.canvas.create_image( shift[0], shift[1], anchor="nw", image=current_render, tag="IMG" )
+        #The frame covers the rendered region; shift is where the render sits relative to orig_top_left
+        frame_origin = self.canvas.orig_image_to_screen(orig_top_left)
+        frame_size = np.round((orig_bottom_right - orig_top_left) * scale)
+        self.__frame_image.show(current_render, shift, frame_origin, frame_size)
+        if not show_filtered:
+            self.__last_frame = (frame_origin, frame_size)
 
-        self.canvas.delete("BlobLayer")
-        if not self.__use_filter_renderer:
-            self.__render_blobs(scale)
+        self.canvas.delete("BlobPointLayer")
+        if not show_filtered:
+            self.__render_blobs(visible_blobs, scale, rasterize_blobs)
+        else:
+            self.__blob_overlay.hide()
 
         self.__draw_new_blob()
 
         if self.__draw_selection_rect:
             self.__draw_selection_box()
 
-    def __render_blobs(self, scale):
+    def __cull_blobs(self, orig_top_left, orig_bottom_right):
+        if not self.__draw_blobs:
+            return None
+        #Cull against the visible region, grown by half the outline width
+        margin = self.master.blob_manager.get_thickness() / 2.0
+        return self.master.blob_manager.get_columns_in_rect(
+            orig_top_left[0] - margin, orig_top_left[1] - margin,
+            orig_bottom_right[0] + margin, orig_bottom_right[1] + margin)
+
+    def __render_blobs(self, visible_blobs, scale, rasterized):
         
         text = "Total Blobs: " + str(len(self.master.blob_manager.get_blobs()))
         self.__right_widget_manager.get_widget("total_blobs").config(text=text)
@@ -403,43 +441,39 @@ class SceneEdit(Scene):
         text = "Selected Blobs: " + str(len(self.master.blob_manager.get_selected_blobs()))
         self.__right_widget_manager.get_widget("selected_blobs").config(text=text)
            
-        if not self.__draw_blobs:
+        if visible_blobs is None:
+            self.__blob_overlay.hide()
             return
 
-        self.canvas.delete("BlobLayer")
-        
         if self.master.blob_manager is not None:
-            #image_with_blobs = self.original_image.copy()
-            selected_blobs = self.master.blob_manager.get_selected_blobs()
             thickness = self.master.blob_manager.get_thickness()
-            #print("total blobs found = " ,len(self.blob_manager.get_blobs()))
-            for blob in self.master.blob_manager.get_blobs():
-                centre = [blob.x, blob.y]  # Convert to integer for pixel coordinates
-                radius = blob.r  # Convert radius to integer
-                
-                color = "green"#(0, 255, 0)  # Color (green in BGR)
-                if blob in selected_blobs:#selected_blob is not None and blob.id == selected_blob.id):
-                    color = "red"#(255, 0, 0)
-
-                #center = self.canvas.orig_image_to_screen(np.array(center))
-                #radius = radius*scale
-                #thickness /= scale
-                top_left = [centre[0]-radius, centre[1] - radius]
-                bottom_right = [centre[0] + radius, centre[1] + radius]
-                x0, y0 = self.canvas.orig_image_to_screen(np.array(top_left))
-                x1, y1 = self.canvas.orig_image_to_screen(np.array(bottom_right))
-                #x0, y0 = center[0] - radius - thickness, center[1] - radius-thickness
-                #x1, y1 = center[0] + radius + thickness, center[1] + radius + thickness
-                    
-                
-                #self.canvas.create_oval( shift[0], shift[1], anchor="nw", image=current_render, tag="BlobLayer" )
-                self.canvas.create_oval(x0, y0, x1, y1, outline=color, width=thickness*scale, tag="BlobLayer")
-
-                #self.canvas.focus_set()
-
-                # Draw the circle (blob)
-                #image_with_blobs = cv2.circle(image_with_blobs, center, radius, color, thickness)
-            #self.image = Image.fromarray(image_with_blobs)
+            ids, xs, ys, rs, selected = visible_blobs
+            if rasterized:
+                #Unselected blobs are already in the image
+                ids, xs, ys, rs, selected = ids[selected], xs[selected], ys[selected], rs[selected], selected[selected]
+
+            #Blobs under a pixel across are drawn as a point density overlay instead of ovals
+            tiny = rs * scale < 0.5
+            self.__render_blob_points(xs[tiny & ~selected], ys[tiny & ~selected], "green")
+            self.__render_blob_points(xs[tiny & selected], ys[tiny & selected], "red")
+            ids, xs, ys, rs, selected = ids[~tiny], xs[~tiny], ys[~tiny], rs[~tiny], selected[~tiny]
+
+            #Screen space bounding boxes for every blob at once
+            top_left = self.canvas.orig_image_to_screen(np.column_stack((xs - rs, ys - rs)))
+            bottom_right = self.canvas.orig_image_to_screen(np.column_stack((xs + rs, ys + rs)))
+            boxes = np.hstack((top_left, bottom_right))
+            colors = np.where(selected, "red", "green")
+            #Only blobs whose box, colour or width changed touch their canvas item
+            self.__blob_overlay.update(ids.tolist(), boxes.tolist(), colors.tolist(), thickness*scale)
+            
+    def __render_blob_points(self, xs, ys, color, cell=2):
+        if len(xs) == 0:
+            return
+        #One small square per occupied cell x cell screen pixel bin
+        screen = self.canvas.orig_image_to_screen(np.column_stack((xs, ys)))
+        bins = np.unique(np.floor(screen / cell).astype(np.int64), axis=0) * cell
+        for x, y in bins.tolist():
+            self.canvas.create_rectangle(x, y, x + cell, y + cell, fill=color, outline="", tag="BlobPointLayer")
             
     def __set_blob_detector_params(self):
         filter_by_color, color = self.__right_widget_manager.get_widget("Color").get_values() 
@@ -487,27 +521,125 @@ class SceneEdit(Scene):
         if not self.master.layer_renderer.is_fg_loaded():
             return
 
-        widget = self.__right_widget_manager.get_widget("detect_blobs")
-        widget.config(text="Processing...")
-        self.__right_widget_manager.disable_widget("detect_blobs")
-        widget.update_idletasks()
-
         self.__set_filter_params()
         self.__set_blob_detector_params()
-        
-        self.__blob_detector.detect_blobs()
-        self.canvas.redraw()
 
+        #Snapshot what the worker needs so the UI can keep changing. Pressing again supersedes this job.
+        filter_processor = self.master.filter_processor
+        blob_detector = self.__blob_detector
+        image = filter_processor.get_bound_image()
+        params = filter_processor.get_filter_params()
+        gray = filter_processor.get_gray_array()
+        detector_params = blob_detector.snapshot_params()
+
+        #With a region of interest only it (plus margins) is filtered and detected, and only its blobs are replaced
+        if self.__right_widget_manager.get_widget("detect_region").get() == "Selection Box" and self.__last_box is None:
+            #Whole image detection would replace every blob, manual edits included
+            print("Draw a selection box before detecting in it")
+            return
+        roi = self.__get_detection_roi()
+        if roi is not None and (roi[2] <= roi[0] or roi[3] <= roi[1]):
+            return
+        region = None if roi is None else blob_detector.get_search_region(roi, *self.master.layer_renderer.get_image_size())
+
+        def work(job):
+            #Detection filters grayscale only; the RGB filtered image is built if it is shown
+            gray_image = gray
+            if gray_image is None:
+                job.report(0.0, "Filtering...")
+                progress = lambda done: job.report(0.6 * done, "Filtering...")
+                if region is None:
+                    gray_image = filter_processor.filter_gray(image, params, progress, job.is_cancelled)
+                else:
+                    gray_image = filter_processor.filter_region(image, params, region, progress, gray=True, cancelled=job.is_cancelled)
+                if job.is_cancelled():
+                    return None
+            elif region is not None:
+                #View into the cached array, no copy
+                gray_image = gray_image[region[1]:region[3], region[0]:region[2]]
+            job.report(0.6, "Detecting...")
+            if region is None:
+                blobs = blob_detector.find_blobs(detector_params, gray_image, job.is_cancelled)
+            else:
+                blobs = blob_detector.find_blobs_in_region(detector_params, gray_image, region, roi, job.is_cancelled)
+            if blobs is None:
+                return None
+            return gray_image, blobs
+
+        def done(result):
+            gray_image, blobs = result
+            if gray is None and region is None:
+                filter_processor.commit_gray(image, params, gray_image)
+            blob_detector.store_blobs(*blobs, roi=roi)
+            self.__on_job_progress(0.0, "Detect Blobs")
+            self.canvas.redraw()
+
+        #After submit, as a superseded job's on_cancel resets the display
+        self.master.background_worker.submit(work, done, self.__on_job_progress, self.__on_job_error, self.__on_job_cancel)
+        self.__on_job_progress(0.0, "Processing...")
+
+    def on_image_loaded(self):
+        self.__last_box = None #A box drawn on the previous image means nothing on this one
+
+    def __get_detection_roi(self):
+        """Return the (x0, y0, x1, y1) region chosen for detection, or None for the whole image."""
+        region = self.__right_widget_manager.get_widget("detect_region").get()
+        if region == "View":
+            top_left, bottom_right = self.canvas.get_visible_region()
+            roi = (top_left[0], top_left[1], bottom_right[0], bottom_right[1])
+        elif region == "Selection Box":
+            roi = self.__last_box
+        else:
+            return None
+
+        width, height = self.master.layer_renderer.get_image_size()
+        return (max(int(roi[0]), 0), max(int(roi[1]), 0),
+                min(int(np.ceil(roi[2])), width), min(int(np.ceil(roi[3])), height))
+
+    def __request_filtered_image(self):
+        """Return True if the filtered image is ready, otherwise start filtering it in the background."""
+        filter_processor = self.master.filter_processor
+        if filter_processor.is_filtered():
+            return True
+        if self.master.background_worker.is_busy():
+            return False
+
+        image = filter_processor.get_bound_image()
+        params = filter_processor.get_filter_params()
+
+        def work(job):
+            job.report(0.0, "Filtering...")
+            return filter_processor.filter_image(image, params, lambda done: job.report(done, "Filtering..."), job.is_cancelled)
+
+        def done(filtered_image):
+            filter_processor.commit_filtered(image, params, filtered_image)
+            self.__on_job_progress(0.0, "Detect Blobs")
+            self.canvas.redraw()
 
-        widget.config(text="Detect Blobs")
-        self.__right_widget_manager.enable_widget("detect_blobs")
-        widget.update_idletasks()
+        self.master.background_worker.submit(work, done, self.__on_job_progress, self.__on_job_error, self.__on_job_cancel)
+        return False
+
+    def __on_job_progress(self, fraction, message):
+        self.__right_widget_manager.get_widget("detect_progress").config(value=fraction)
+        self.__right_widget_manager.get_widget("detect_blobs").config(text=message)
+
+    def __on_job_error(self, error):
+        print("Blob detection failed:", error)
+        self.__on_job_progress(0.0, "Detect Blobs")
+
+    def __on_job_cancel(self):
+        self.__on_job_progress(0.0, "Detect Blobs")
 
 
     def __on_opacity_change(self, val):
         self.fg_opacity = float(val)
-        #self.master.layer_renderer.set_opacity(float(val))
-        self.canvas.redraw()
+        #Only the blend changes: re-blend the crops of the last render and swap the image, blob items stay as they are
+        if self.__last_frame is not None and not self.canvas.is_redraw_pending() \
+                and self.master.layer_renderer.reblend(self.fg_opacity):
+            current_render, shift = self.master.layer_renderer.get_render()
+            self.__frame_image.show(current_render, shift, *self.__last_frame)
+        else:
+            self.canvas.redraw()
 
 
     def __toggle_renderer(self):
@@ -0,0 +1,55 @@
+from collections import OrderedDict
+
+
+class TileCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        """
+        Least recently used cache of rendered image tiles with a memory cap.
+        :param max_bytes: Total size of cached tiles before the oldest are evicted.
+        """
+        self.__tiles = OrderedDict()
+        self.__bytes = 0
+        self.__max_bytes = max_bytes
+
+    def get(self, key):
+        """Return the tile stored under key, or None, marking it as recently used."""
+        entry = self.__tiles.get(key)
+        if entry is None:
+            return None
+        self.__tiles.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, tile, nbytes=None):
+        """
+        Store a tile under key, evicting least recently used tiles over the cap.
+        :param nbytes: Size to account for the tile, defaults to tile.nbytes for NumPy arrays.
+        """
+        if nbytes is None:
+            nbytes = tile.nbytes
+        self.discard(key)
+        self.__tiles[key] = (tile, nbytes)
+        self.__bytes += nbytes
+        while self.__bytes > self.__max_bytes and len(self.__tiles) > 1:
+            _, (_, evicted_bytes) = self.__tiles.popitem(last=False)
+            self.__bytes -= evicted_bytes
+
+    def discard(self, key):
+        entry = self.__tiles.pop(key, None)
+        if entry is not None:
+            self.__bytes -= entry[1]
+
+    def clear(self):
+        self.__tiles.clear()
+        self.__bytes = 0
+
+    def set_max_bytes(self, max_bytes):
+        self.__max_bytes = max_bytes
+
+    def get_size_bytes(self):
+        return self.__bytes
+
+    def __contains__(self, key):
+        return key in self.__tiles
+
+    def __len__(self):
+        return len(self.__tiles)